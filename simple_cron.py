@@ -0,0 +1,112 @@
+import datetime
+
+# Field order and ranges of a standard five-field cron expression
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6)
+)
+
+# Shorthands accepted in place of the five fields
+CRON_MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *"
+}
+
+def parse_field(text, low, high, name):
+    """Parse one cron field into the set of values it matches."""
+    # Sunday may be written as 7 as well as 0
+    top = 7 if name == "weekday" else high
+    
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"Invalid step in {name} field: {text}")
+        
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            end = top if step > 1 else start
+        
+        if start < low or end > top or start > end:
+            raise ValueError(f"Value out of range in {name} field: {text}")
+        
+        values.update(value % 7 if name == "weekday" else value
+                      for value in range(start, end + 1, step))
+    return values
+
+def parse_cron(expression):
+    """Parse a cron expression such as ``*/5 * * * *`` or ``@hourly``.
+    
+    Returns a dict of field name to matching values, plus flags telling
+    whether the day and weekday fields were restricted. Raises ValueError
+    if the expression is malformed.
+    """
+    expression = CRON_MACROS.get(expression.strip().lower(), expression)
+    parts = expression.split()
+    if len(parts) != len(CRON_FIELDS):
+        raise ValueError(f"Expected {len(CRON_FIELDS)} fields in cron expression: {expression}")
+    
+    cron = {}
+    try:
+        for text, (name, low, high) in zip(parts, CRON_FIELDS):
+            cron[name] = parse_field(text, low, high, name)
+    except ValueError as e:
+        raise ValueError(f"Invalid cron expression '{expression}': {e}")
+    
+    cron["day_restricted"] = parts[2] != "*"
+    cron["weekday_restricted"] = parts[4] != "*"
+    return cron
+
+def day_matches(cron, moment):
+    """Check the day of month and day of week fields, with cron's OR rule."""
+    day = moment.day in cron["day"]
+    # datetime counts weekdays from Monday, cron from Sunday
+    weekday = (moment.weekday() + 1) % 7 in cron["weekday"]
+    if cron["day_restricted"] and cron["weekday_restricted"]:
+        return day or weekday
+    return day and weekday
+
+def next_cron_time(cron, after):
+    """Return the first timestamp after ``after`` matched by a parsed cron expression.
+    
+    Times are evaluated in local time. Instead of stepping minute by minute,
+    whole months, days and hours that cannot match are skipped.
+    """
+    moment = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+    moment += datetime.timedelta(minutes=1)
+    limit = moment + datetime.timedelta(days=366 * 5)
+    
+    while moment < limit:
+        if moment.month not in cron["month"]:
+            year, month = divmod(moment.month, 12)
+            moment = moment.replace(year=moment.year + year, month=month + 1, day=1,
+                                    hour=0, minute=0)
+            continue
+        if not day_matches(cron, moment):
+            moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            continue
+        if moment.hour not in cron["hour"]:
+            moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            continue
+        if moment.minute not in cron["minute"]:
+            moment += datetime.timedelta(minutes=1)
+            continue
+        return moment.timestamp()
+    
+    raise ValueError("Cron expression never matches")
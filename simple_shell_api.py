@@ -0,0 +1,429 @@
+import asyncio
+import http.client
+import io
+import json
+import queue
+import time
+import urllib.parse
+
+# Job statuses after which a job produces no more output
+FINISHED_STATUSES = ("done", "error", "cancelled", "expired", "lost")
+
+# Seconds each request long-polls the server for; the server caps it at 30
+POLL_WAIT = 25
+
+# Bytes requested per page when reading a job's output
+PAGE_SIZE = 1024 * 1024
+
+class ShellAPIError(Exception):
+    """An error response from the server."""
+    
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+def build_path(prefix, path, params=None):
+    """Return the request path for an endpoint, with its query string."""
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    query = "?" + urllib.parse.urlencode(params, doseq=True) if params else ""
+    return prefix + path + query
+
+def parse_json(status, payload):
+    """Decode a JSON response, raising ShellAPIError for error statuses."""
+    try:
+        data = json.loads(payload.decode('utf-8')) if payload else {}
+    except ValueError:
+        data = {"error": payload.decode('utf-8', errors='replace')}
+    if status >= 400:
+        raise ShellAPIError(status, data.get("error", "Request failed"))
+    return data
+
+def parse_page(status, headers, payload):
+    """Decode a /jobs/<id>/output response into (data, next offset, size, status)."""
+    if status >= 400:
+        parse_json(status, payload)
+    return (payload, int(headers.get("X-Next-Offset", 0)), int(headers.get("X-Output-Size", 0)),
+            headers.get("X-Job-Status"))
+
+def command_request(command, agent=None, **options):
+    """Return the body of a POST /command request."""
+    body = {"command": command, "agent": agent}
+    body.update(options)
+    return {key: value for key, value in body.items() if value is not None}
+
+def fanout_request(command, agents=None, timeout=None, normalize=None, **options):
+    """Return the body of a POST /fanouts request.
+    
+    ``agents`` is a list of agent ids or a dict of facts selecting them.
+    """
+    body = {"command": command, "timeout": timeout, "normalize": normalize}
+    if isinstance(agents, dict):
+        body["selector"] = agents
+    else:
+        body["agents"] = agents
+    body.update(options)
+    return {key: value for key, value in body.items() if value is not None}
+
+def remaining_wait(deadline):
+    """Return how long the next long-poll may wait, given an overall deadline."""
+    if deadline is None:
+        return POLL_WAIT
+    return max(0, min(POLL_WAIT, deadline - time.monotonic()))
+
+class ShellClient:
+    """Client for the server's HTTP API over pooled keep-alive connections.
+    
+    Connections are reused between requests instead of being opened for
+    each one, and waiting for jobs uses the server's long-polling, so
+    scripts never poll /output themselves. Safe to share between threads.
+    """
+    
+    def __init__(self, base_url="http://localhost:8080", timeout=60, pool_size=4):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout  # socket timeout; must exceed POLL_WAIT
+        self.pool = queue.LifoQueue(pool_size)  # idle connections
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    def request(self, method, path, params=None, body=None):
+        """Send a request on a pooled connection and return (status, headers, payload).
+        
+        A request that fails on a reused connection, which the server may
+        have closed while it was idle, is retried once on a new one.
+        """
+        target = build_path(self.prefix, path, params)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers["Content-Type"] = "application/json"
+        
+        for attempt in range(2):
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            reused = conn.sock is not None
+            
+            try:
+                conn.request(method, target, data, headers)
+                response = conn.getresponse()
+                payload = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self.pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return response.status, response.headers, payload
+    
+    def call(self, method, path, params=None, body=None):
+        """Send a request and return its decoded JSON response."""
+        status, headers, payload = self.request(method, path, params, body)
+        return parse_json(status, payload)
+    
+    def status(self):
+        """Return the server status."""
+        return self.call("GET", "/status")
+    
+    def agents(self, connected=None, **facts):
+        """Return the agents whose facts match, e.g. ``agents(os="Linux")``."""
+        params = dict(facts, connected="true" if connected else None)
+        return self.call("GET", "/agents", params)["agents"]
+    
+    def submit(self, command, agent=None, **options):
+        """Queue a command and return its job id.
+        
+        ``options`` are the other fields of POST /command, such as
+        ``priority``, ``deadline``, ``filter`` and ``max_output``.
+        """
+        return self.call("POST", "/command", body=command_request(command, agent, **options))["job_id"]
+    
+    def job(self, job_id, wait=None):
+        """Return a job, waiting up to ``wait`` seconds for it to finish."""
+        return self.call("GET", f"/jobs/{job_id}", {"wait": wait})["job"]
+    
+    def wait(self, job_id, timeout=None):
+        """Wait until a job has finished, or ``timeout`` seconds, and return it."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.job(job_id, wait=remaining_wait(deadline))
+            if job["finished"] is not None or remaining_wait(deadline) == 0:
+                return job
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job."""
+        return self.call("DELETE", f"/jobs/{job_id}")
+    
+    def run(self, agent, command, timeout=None, **options):
+        """Run a command on an agent (None for the current one) and return the finished job."""
+        return self.wait(self.submit(command, agent, **options), timeout)
+    
+    def batch(self, commands, agent=None, timeout=None, **options):
+        """Run several commands on an agent and return their jobs, in order.
+        
+        All commands are queued before waiting, so they run as the agent's
+        scheduler allows rather than one after the other.
+        """
+        job_ids = [self.submit(command, agent, **options) for command in commands]
+        return [self.wait(job_id, timeout) for job_id in job_ids]
+    
+    def fanout(self, command, agents=None, timeout=None, **options):
+        """Run a command on several agents and return their jobs by agent id.
+        
+        ``agents`` is a list of agent ids, or a dict of facts selecting the
+        connected agents to run on; by default every connected agent.
+        """
+        if agents is None or isinstance(agents, dict):
+            agents = [agent["id"] for agent in self.agents(connected=True, **(agents or {}))]
+        job_ids = {agent: self.submit(command, agent, **options) for agent in agents}
+        return {agent: self.wait(job_id, timeout) for agent, job_id in job_ids.items()}
+    
+    def aggregate(self, command, agents=None, timeout=None, normalize=None, **options):
+        """Run a command on several agents and return their results grouped by output.
+        
+        Unlike fanout() the server does the grouping, so each distinct output
+        is transferred once; ``result["summary"]`` reads like "412 hosts:
+        output A, 3 hosts: output B, 2 timed out". Agents still running
+        after ``timeout`` seconds are counted as timed out.
+        """
+        body = fanout_request(command, agents, timeout, normalize, **options)
+        fanout_id = self.call("POST", "/fanouts", body=body)["fanout_id"]
+        while True:
+            fanout = self.call("GET", f"/fanouts/{fanout_id}", {"wait": POLL_WAIT})["fanout"]
+            if fanout["complete"]:
+                return fanout
+    
+    def read_output(self, job_id, offset=0, length=PAGE_SIZE, wait=None):
+        """Read a page of a job's output; returns (data, next offset, size, status)."""
+        status, headers, payload = self.request("GET", f"/jobs/{job_id}/output",
+                                                {"offset": offset, "length": length, "wait": wait})
+        return parse_page(status, headers, payload)
+    
+    def stream(self, job_id, offset=0):
+        """Yield a job's output as it arrives, as chunks of bytes, until the job finishes."""
+        while True:
+            data, offset, size, status = self.read_output(job_id, offset, wait=POLL_WAIT)
+            if data:
+                yield data
+            elif status in FINISHED_STATUSES and offset >= size:
+                return
+    
+    def output(self, job_id):
+        """Return the full spooled output of a job, waiting for it to finish."""
+        return b"".join(self.stream(job_id))
+
+class AsyncShellClient:
+    """asyncio variant of ShellClient, with a minimal HTTP/1.1 keep-alive client.
+    
+    At most ``pool_size`` requests are in flight at a time; the others wait
+    for a connection to become free.
+    """
+    
+    def __init__(self, base_url="http://localhost:8080", timeout=60, pool_size=10):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle = []  # (reader, writer) pairs of idle connections
+        self.slots = None  # created on first use, inside the event loop
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    async def close(self):
+        """Close the idle connections."""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+    
+    async def read_response(self, reader):
+        """Read one response; returns (status, headers, payload, keep_alive)."""
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        
+        header_lines = b""
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines += line
+        headers = http.client.parse_headers(io.BytesIO(header_lines + b"\r\n"))
+        
+        keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            payload = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                payload += await reader.readexactly(size)
+                await reader.readline()
+            payload = bytes(payload)
+        elif headers.get("Content-Length") is not None:
+            payload = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            payload = await reader.read()
+            keep_alive = False
+        return int(status), headers, payload, keep_alive
+    
+    async def request(self, method, path, params=None, body=None):
+        """Send a request on a pooled connection and return (status, headers, payload)."""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pool_size)
+        data = b"" if body is None else json.dumps(body).encode('utf-8')
+        head = (f"{method} {build_path(self.prefix, path, params)} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                f"Content-Length: {len(data)}\r\n")
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        message = (head + "\r\n").encode('latin-1') + data
+        
+        async with self.slots:
+            for attempt in range(2):
+                reused = bool(self.idle)
+                if reused:
+                    reader, writer = self.idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                    status, headers, payload, keep_alive = await asyncio.wait_for(
+                        self.read_response(reader), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                
+                if keep_alive:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, headers, payload
+    
+    async def call(self, method, path, params=None, body=None):
+        """Send a request and return its decoded JSON response."""
+        status, headers, payload = await self.request(method, path, params, body)
+        return parse_json(status, payload)
+    
+    async def status(self):
+        """Return the server status."""
+        return await self.call("GET", "/status")
+    
+    async def agents(self, connected=None, **facts):
+        """Return the agents whose facts match, e.g. ``agents(os="Linux")``."""
+        params = dict(facts, connected="true" if connected else None)
+        return (await self.call("GET", "/agents", params))["agents"]
+    
+    async def submit(self, command, agent=None, **options):
+        """Queue a command and return its job id."""
+        body = command_request(command, agent, **options)
+        return (await self.call("POST", "/command", body=body))["job_id"]
+    
+    async def job(self, job_id, wait=None):
+        """Return a job, waiting up to ``wait`` seconds for it to finish."""
+        return (await self.call("GET", f"/jobs/{job_id}", {"wait": wait}))["job"]
+    
+    async def wait(self, job_id, timeout=None):
+        """Wait until a job has finished, or ``timeout`` seconds, and return it."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = await self.job(job_id, wait=remaining_wait(deadline))
+            if job["finished"] is not None or remaining_wait(deadline) == 0:
+                return job
+    
+    async def cancel(self, job_id):
+        """Cancel a queued or running job."""
+        return await self.call("DELETE", f"/jobs/{job_id}")
+    
+    async def run(self, agent, command, timeout=None, **options):
+        """Run a command on an agent (None for the current one) and return the finished job."""
+        return await self.wait(await self.submit(command, agent, **options), timeout)
+    
+    async def batch(self, commands, agent=None, timeout=None, **options):
+        """Run several commands on an agent and return their jobs, in order."""
+        job_ids = [await self.submit(command, agent, **options) for command in commands]
+        return list(await asyncio.gather(*(self.wait(job_id, timeout) for job_id in job_ids)))
+    
+    async def fanout(self, command, agents=None, timeout=None, **options):
+        """Run a command on several agents and return their jobs by agent id.
+        
+        ``agents`` is a list of agent ids, or a dict of facts selecting the
+        connected agents to run on; by default every connected agent.
+        """
+        if agents is None or isinstance(agents, dict):
+            agents = [agent["id"] for agent in await self.agents(connected=True, **(agents or {}))]
+        job_ids = await asyncio.gather(*(self.submit(command, agent, **options) for agent in agents))
+        results = await asyncio.gather(*(self.wait(job_id, timeout) for job_id in job_ids))
+        return dict(zip(agents, results))
+    
+    async def aggregate(self, command, agents=None, timeout=None, normalize=None, **options):
+        """Run a command on several agents and return their results grouped by output."""
+        body = fanout_request(command, agents, timeout, normalize, **options)
+        fanout_id = (await self.call("POST", "/fanouts", body=body))["fanout_id"]
+        while True:
+            fanout = (await self.call("GET", f"/fanouts/{fanout_id}", {"wait": POLL_WAIT}))["fanout"]
+            if fanout["complete"]:
+                return fanout
+    
+    async def read_output(self, job_id, offset=0, length=PAGE_SIZE, wait=None):
+        """Read a page of a job's output; returns (data, next offset, size, status)."""
+        status, headers, payload = await self.request(
+            "GET", f"/jobs/{job_id}/output", {"offset": offset, "length": length, "wait": wait})
+        return parse_page(status, headers, payload)
+    
+    async def stream(self, job_id, offset=0):
+        """Yield a job's output as it arrives, as chunks of bytes, until the job finishes."""
+        while True:
+            data, offset, size, status = await self.read_output(job_id, offset, wait=POLL_WAIT)
+            if data:
+                yield data
+            elif status in FINISHED_STATUSES and offset >= size:
+                return
+    
+    async def output(self, job_id):
+        """Return the full spooled output of a job, waiting for it to finish."""
+        return b"".join([data async for data in self.stream(job_id)])
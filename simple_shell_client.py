@@ -7,33 +7,403 @@ import json
 import threading
 import os
 import signal
+import base64
+import uuid
+import re
+import collections
+import difflib
 
 # Global variables
 running = True
-process = None
 client_socket = None
 
-def send_message(sock, msg_type, data):
-    """Send a JSON-formatted message to the server."""
+# Outgoing messages. Job threads and the main loop share the connection;
+# messages queued at about the same time are coalesced into one vectored
+# write. A batch smaller than FLUSH_BYTES waits up to FLUSH_DELAY seconds
+# for more messages, which replaces Nagle's algorithm (TCP_NODELAY is set)
+# without its delayed-ACK stalls.
+FLUSH_DELAY = 0.002  # seconds
+FLUSH_BYTES = 64 * 1024
+MAX_IOV = 1024  # buffers passed to one sendmsg() call (IOV_MAX on Linux and BSD)
+send_buffers = {}  # socket -> SendBuffer
+
+# Agent identity reported to the server; set SHELL_AGENT_ID to override
+AGENT_ID = os.environ.get("SHELL_AGENT_ID") or f"{platform.node()}-{uuid.getnode():012x}"
+
+# Labels reported with the agent's facts, e.g. SHELL_AGENT_LABELS="rack3,lab"
+AGENT_LABELS = [label.strip() for label in os.environ.get("SHELL_AGENT_LABELS", "").split(",")
+                if label.strip()]
+FACTS_INTERVAL = 60  # seconds between checks for changed facts
+
+# Watch jobs: the last output sent for each watch, so that the next run
+# only needs to send a diff against it
+WATCH_MAX_OUTPUT = 1024 * 1024  # bytes of output kept per watch
+WATCH_SNAPSHOT_EVERY = 20  # runs between full snapshots
+watch_states = {}
+
+# Flow control: bytes of output each job may still send before the server
+# grants more credit, and the window each job started with. Jobs without an
+# entry are not flow controlled. Credit is per connection and is reset to
+# the full window after reconnecting.
+job_credits = {}
+job_windows = {}
+credit_cond = threading.Condition()
+
+# Final job results that could not be sent because the connection was down;
+# they are sent again after reconnecting
+unsent_results = []
+results_lock = threading.Lock()
+
+# Jobs currently executing, by job id (None until the process is started),
+# and jobs the server asked to cancel
+running_jobs = {}
+cancelled_jobs = set()
+jobs_lock = threading.Lock()
+
+# Output limits
+COMMAND_TIMEOUT = 30  # seconds
+OUTPUT_CHUNK_BYTES = 64 * 1024  # bytes read from the pipe and sent per chunk
+OUTPUT_HEAD_BYTES = 16 * 1024  # bytes kept from the start of the output
+OUTPUT_TAIL_BYTES = 16 * 1024  # bytes kept from the end of the output
+MAX_OUTPUT_BYTES = 64 * 1024 * 1024  # bytes spooled to the server per job
+MAX_LINE_BYTES = 1024 * 1024  # longer lines are split when filtering
+
+# Exit code of a process killed by kill_process()
+KILLED_EXIT_CODE = 1 if platform.system() == 'Windows' else -signal.SIGKILL
+
+# ru_maxrss is reported in kilobytes, except on macOS where it is in bytes
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+def total_memory():
+    """Return the total physical memory in bytes, or None if unknown."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def collect_facts():
+    """Collect the structured facts the server keeps in its inventory."""
+    return {
+        "hostname": platform.node(),
+        "os": platform.system(),
+        "os_release": platform.release(),
+        "arch": platform.machine(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "memory": total_memory(),
+        "labels": AGENT_LABELS
+    }
+
+def send_frames(sock, frames):
+    """Write encoded messages to a socket with as few calls as possible.
+    
+    Returns the number of send calls made. Partial writes are resumed from
+    where they stopped. The socket's timeout is meant for receiving; a send
+    that times out because the server is not reading for a while is retried.
+    """
+    if hasattr(sock, "sendmsg"):
+        views = [memoryview(frame) for frame in frames]
+        send = lambda: sock.sendmsg(views[:MAX_IOV])
+    else:
+        # No vectored I/O on this platform
+        views = [memoryview(b"".join(frames))]
+        send = lambda: sock.send(views[0])
+    
+    calls = 0
+    while views:
+        try:
+            sent = send()
+        except socket.timeout:
+            continue
+        calls += 1
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+    return calls
+
+class SendBuffer:
+    """Outgoing messages of one connection, written in batches by a writer thread.
+    
+    Senders queue encoded messages; the writer sends everything queued with
+    one vectored write. Output chunks do not wait for the write, so a job
+    reads its next chunk while the previous one is on the wire; their
+    memory is bounded by the job's flow control credit. The writer only
+    holds a small batch back while nobody is waiting for it, so a job's
+    last chunk and its result go out together without delaying the result.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.frames = []
+        self.size = 0
+        self.queued = 0  # messages queued since the connection was made
+        self.flushed = 0  # messages written to the socket
+        self.send_calls = 0
+        self.waiting = 0  # senders blocked until their message is written
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def send(self, frame, wait=True):
+        """Queue a message, by default returning once it is written.
+        
+        Raises ConnectionError if the connection failed or was closed.
+        """
+        with self.cond:
+            if self.error or self.closed:
+                raise ConnectionError(f"Connection closed: {self.error}" if self.error
+                                      else "Connection closed")
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.queued += 1
+            seq = self.queued
+            self.cond.notify_all()
+            
+            if not wait:
+                return
+            self.waiting += 1
+            try:
+                while self.flushed < seq:
+                    if self.error:
+                        raise ConnectionError(f"Connection failed: {self.error}")
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+    
+    def run(self):
+        """Writer thread: send queued messages until the buffer is closed."""
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed:
+                    self.cond.wait()
+                if not self.frames:
+                    return
+                
+                # Give messages sent at about the same time a chance to join
+                deadline = time.time() + FLUSH_DELAY
+                while (self.size < FLUSH_BYTES and not self.waiting and not self.closed
+                       and time.time() < deadline):
+                    self.cond.wait(deadline - time.time())
+                frames, end = self.frames, self.queued
+                self.frames, self.size = [], 0
+            
+            try:
+                calls = send_frames(self.sock, frames)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            
+            with self.cond:
+                self.flushed = end
+                self.send_calls += calls
+                self.cond.notify_all()
+    
+    def close(self):
+        """Stop accepting messages and let the writer send what is queued."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(1)
+
+def send_message(sock, msg_type, data, wait=True, **fields):
+    """Send a JSON-formatted message to the server.
+    
+    With ``wait`` false the message is only queued for sending.
+    """
     try:
         # Create message object
         msg_obj = {"type": msg_type, "data": data}
+        msg_obj.update(fields)
         
         # Convert to JSON string with proper formatting
         message = json.dumps(msg_obj, ensure_ascii=False) + "\n"
         
-        # Send with explicit UTF-8 encoding
-        sock.sendall(message.encode('utf-8'))
+        # Send with explicit UTF-8 encoding, batched with other messages
+        send_buffers[sock].send(message.encode('utf-8'), wait)
         
-        print(f"Sent message: {message.strip()}")
+        print(f"Sent message: {message.strip()[:200]}")
         return True
     except Exception as e:
         print(f"Error sending message: {e}")
         return False
 
-def execute_command(command):
-    """Execute a shell command and return the output."""
-    global process
+def summarize_output(head, tail, total):
+    """Build the text shown for an output of ``total`` bytes from its head and tail."""
+    if total <= len(head):
+        return head.decode('utf-8', errors='replace'), False
+    
+    missing = total - len(head)
+    if missing <= len(tail):
+        # Head and tail together cover the whole output
+        return (head + tail[-missing:]).decode('utf-8', errors='replace'), False
+    
+    omitted = missing - len(tail)
+    text = (head.decode('utf-8', errors='replace')
+            + f"\n... [{omitted} bytes truncated] ...\n"
+            + tail.decode('utf-8', errors='replace'))
+    return text, True
+
+def filter_output(chunks, spec, tail_bytes=MAX_OUTPUT_BYTES):
+    """Apply a job's output filter to a stream of byte chunks.
+    
+    ``spec`` may contain ``include`` and ``exclude`` regular expressions,
+    matched against each line, and ``head``, ``tail`` and ``max_bytes``
+    limits, applied in that order like ``grep | head | tail``. Filtered
+    output is yielded in blocks of at most OUTPUT_CHUNK_BYTES; the generator
+    returns early once ``head`` lines or ``max_bytes`` bytes have been
+    produced and no tail is needed. The lines kept for ``tail`` are also
+    limited to ``tail_bytes`` bytes, keeping at least the last line.
+    """
+    include = re.compile(spec["include"].encode('utf-8')) if spec.get("include") else None
+    exclude = re.compile(spec["exclude"].encode('utf-8')) if spec.get("exclude") else None
+    head = spec.get("head")
+    tail = collections.deque() if spec.get("tail") else None
+    max_bytes = spec.get("max_bytes")
+    
+    matched = 0
+    emitted = 0
+    tail_size = 0
+    partial = b""
+    
+    def lines():
+        nonlocal partial
+        for chunk in chunks:
+            data = partial + chunk
+            parts = data.split(b"\n")
+            partial = parts.pop()
+            for line in parts:
+                yield line + b"\n"
+            if len(partial) > MAX_LINE_BYTES:
+                yield partial
+                partial = b""
+        if partial:
+            yield partial
+    
+    def take_blocks(block, final=False):
+        # Full blocks, and at the end whatever is left, in bounded pieces
+        while len(block) >= OUTPUT_CHUNK_BYTES or (final and block):
+            yield bytes(block[:OUTPUT_CHUNK_BYTES])
+            del block[:OUTPUT_CHUNK_BYTES]
+    
+    block = bytearray()
+    for line in lines():
+        if include and not include.search(line):
+            continue
+        if exclude and exclude.search(line):
+            continue
+        matched += 1
+        
+        if tail is not None:
+            tail.append(line)
+            tail_size += len(line)
+            while len(tail) > spec["tail"] or (tail_size > tail_bytes and len(tail) > 1):
+                tail_size -= len(tail.popleft())
+        else:
+            if max_bytes is not None:
+                line = line[:max_bytes - emitted]
+            block += line
+            emitted += len(line)
+            yield from take_blocks(block)
+            if max_bytes is not None and emitted >= max_bytes:
+                break
+        
+        if head and matched >= head:
+            break
+    
+    if tail is not None:
+        while tail:
+            line = tail.popleft()
+            if max_bytes is not None:
+                line = line[:max_bytes - emitted]
+            block += line
+            emitted += len(line)
+            yield from take_blocks(block)
+    yield from take_blocks(block, final=True)
+
+def wait_for_process(process):
+    """Wait for a process to exit and return its resource usage, or None.
+    
+    The process is reaped with os.wait4() so that its CPU time and peak
+    memory, including those of the children it waited for (such as the
+    command run by the shell), are known. Where wait4() is not available,
+    or another thread has already reaped the process, this falls back to
+    Popen.wait() and no usage is returned.
+    """
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+    
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        return None
+    # Same convention as Popen: a negative code is the signal that killed it
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return {
+        "user_time": round(rusage.ru_utime, 6),
+        "system_time": round(rusage.ru_stime, 6),
+        "max_rss": rusage.ru_maxrss * RSS_UNIT
+    }
+
+def kill_process(process):
+    """Kill a command together with every process it started.
+    
+    Commands run in a session of their own (a process group on Windows), so
+    that children of the shell, which hold the output pipe open, are killed
+    as well and reading the pipe ends.
+    """
+    try:
+        if platform.system() == 'Windows':
+            if process.poll() is None:
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+
+def execute_command(command, on_chunk=None, max_output=MAX_OUTPUT_BYTES, job_id=None,
+                    output_filter=None):
+    """Execute a shell command and return a summary of its output.
+    
+    The output is read from the pipe as raw bytes in chunks instead of being
+    decoded into a single string. Each chunk is passed to
+    ``on_chunk(offset, data)`` until ``max_output`` bytes have been spooled;
+    only the head and tail of the output are kept in memory.
+    
+    When a ``job_id`` is given the process can be killed with cancel_job().
+    An ``output_filter`` (see filter_output()) is applied while the process
+    runs, and the process is killed once the filter needs no more input.
+    
+    The result includes the resource usage of the command: wall time,
+    user and system CPU time, peak memory, exit code and bytes read. A
+    command stopped by the filter reports exit code 0 and
+    ``stopped_by_filter``.
+    """
+    process = None
+    cancelled = False
+    eof = False
+    head = bytearray()
+    tail = bytearray()
+    total = 0
+    spooled = 0
+    read = 0
+    timer = None
+    timer_fired = False
+    stopped_by_filter = False
+    usage = None
+    started = time.monotonic()
     
     try:
         # Determine the shell to use
@@ -42,22 +412,300 @@ def execute_command(command):
             # On Windows, we need to use cmd.exe
             command = f"cmd.exe /c {command}"
         
-        # Run the command
-        result = subprocess.run(
+        # Start the command with an unbuffered binary pipe, in its own
+        # session so that kill_process() reaches everything it starts
+        if platform.system() == 'Windows':
+            group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            group = {"start_new_session": True}
+        process = subprocess.Popen(
             command,
             shell=shell,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            timeout=30  # 30 second timeout
+            bufsize=0,
+            **group
         )
+        if job_id:
+            with jobs_lock:
+                running_jobs[job_id] = process
+                if job_id in cancelled_jobs:
+                    # Cancelled before the process existed
+                    kill_process(process)
+        
+        def expire():
+            nonlocal timer_fired
+            timer_fired = True
+            kill_process(process)
+        
+        timer = threading.Timer(COMMAND_TIMEOUT, expire)
+        timer.start()
+        
+        def read_chunks():
+            nonlocal eof, read
+            while True:
+                chunk = process.stdout.read(OUTPUT_CHUNK_BYTES)
+                if not chunk:
+                    eof = True
+                    return
+                read += len(chunk)
+                yield chunk
+        
+        stream = read_chunks()
+        if output_filter:
+            stream = filter_output(stream, output_filter, max_output)
+        
+        for chunk in stream:
+            if len(head) < OUTPUT_HEAD_BYTES:
+                head += chunk[:OUTPUT_HEAD_BYTES - len(head)]
+            tail += chunk
+            if len(tail) > OUTPUT_TAIL_BYTES:
+                del tail[:-OUTPUT_TAIL_BYTES]
+            
+            if on_chunk and spooled < max_output:
+                part = chunk[:max_output - spooled]
+                on_chunk(spooled, part)
+                spooled += len(part)
+            total += len(chunk)
+        
+        if not eof:
+            # The filter has all it needs; stop the command early
+            kill_process(process)
+            stopped_by_filter = True
+        usage = wait_for_process(process)
+        with jobs_lock:
+            cancelled = job_id in cancelled_jobs
+        timed_out = timer_fired and process.returncode != 0 and not cancelled
+        
+        output, truncated = summarize_output(head, tail, total)
+        if timed_out:
+            output += f"\nCommand timed out after {COMMAND_TIMEOUT} seconds"
+        elif cancelled:
+            output += "\nCommand cancelled"
+    except Exception as e:
+        output, truncated = f"Error executing command: {e}", False
+    finally:
+        if timer:
+            timer.cancel()
+        if process:
+            # Also ends whatever the command left running in the background
+            kill_process(process)
+            if process.returncode is None:
+                usage = wait_for_process(process)
+        if process and process.stdout:
+            process.stdout.close()
+        if job_id:
+            with jobs_lock:
+                running_jobs.pop(job_id, None)
+                cancelled_jobs.discard(job_id)
+    
+    exit_code = process.returncode if process else None
+    if stopped_by_filter and exit_code == KILLED_EXIT_CODE:
+        # Killed because its output was no longer needed, not a failure
+        exit_code = 0
+    usage = dict(usage or {"user_time": None, "system_time": None, "max_rss": None},
+                 wall_time=round(time.monotonic() - started, 6),
+                 exit_code=exit_code,
+                 bytes_read=read,
+                 stopped_by_filter=stopped_by_filter)
+    return {
+        "output": output,
+        "total_bytes": total,
+        "spooled_bytes": spooled,
+        "truncated": truncated,
+        "cancelled": cancelled,
+        "usage": usage
+    }
+
+def cancel_job(job_id):
+    """Kill the process of a running job at the server's request.
+    
+    Jobs that already finished, or that this agent never received, are
+    ignored.
+    """
+    with jobs_lock:
+        if job_id not in running_jobs:
+            return
+        cancelled_jobs.add(job_id)
+        process = running_jobs.get(job_id)
+    if process:
+        print(f"Cancelling job {job_id}")
+        kill_process(process)
+    with credit_cond:
+        credit_cond.notify_all()  # a job waiting for credit gives up
+
+def add_credit(job_id, amount):
+    """Record credit granted by the server and wake the job waiting for it."""
+    with credit_cond:
+        if job_id in job_credits:
+            job_credits[job_id] += amount
+            credit_cond.notify_all()
+
+def reset_credits():
+    """Give every flow-controlled job its full window again on a new connection."""
+    with credit_cond:
+        for job_id in job_credits:
+            job_credits[job_id] = job_windows[job_id]
+        credit_cond.notify_all()
+
+def wait_for_credit(job_id, size):
+    """Block until a job may send ``size`` more bytes, then use up that credit.
+    
+    While a job waits here it does not read from its pipe, so a command
+    producing output faster than the server takes it is held up by the OS.
+    A chunk larger than the window only needs the full window, and a
+    cancelled job stops waiting so that it can finish.
+    """
+    with credit_cond:
+        if job_id not in job_credits:
+            return
+        while job_credits[job_id] < min(size, job_windows[job_id]):
+            if not running:
+                raise ConnectionError("Shutting down while waiting for credit")
+            if job_id in cancelled_jobs:
+                break
+            credit_cond.wait(1)
+        job_credits[job_id] -= size
+
+def send_result(msg_type, data, **fields):
+    """Send a job's final message on the current connection.
+    
+    If the connection is down the message is kept and sent again by
+    send_unsent_results() once the client has reconnected.
+    """
+    with results_lock:
+        if not (client_socket and send_message(client_socket, msg_type, data, **fields)):
+            print(f"Keeping result of job {fields.get('job_id')} until reconnected")
+            unsent_results.append((msg_type, data, fields))
+
+def send_unsent_results(sock):
+    """Send the results of jobs that finished while the connection was down."""
+    with results_lock:
+        while unsent_results:
+            msg_type, data, fields = unsent_results[0]
+            if not send_message(sock, msg_type, data, **fields):
+                break
+            unsent_results.pop(0)
+
+def run_job(command, job_id=None, max_output=MAX_OUTPUT_BYTES, output_filter=None,
+            credit=None):
+    """Run a command for the server, streaming spooled chunks and the final summary.
+    
+    Output goes to whichever connection is current, so a job keeps running
+    across a reconnect.
+    """
+    def send_chunk(offset, data):
+        # Credit is granted for spooled bytes, so no piece may exceed the window
+        for start in range(0, len(data), OUTPUT_CHUNK_BYTES):
+            piece = data[start:start + OUTPUT_CHUNK_BYTES]
+            wait_for_credit(job_id, len(piece))
+            send_message(client_socket, "output_chunk", base64.b64encode(piece).decode('ascii'),
+                         wait=False, job_id=job_id, offset=offset + start)
+    
+    if job_id and credit:
+        with credit_cond:
+            job_credits[job_id] = job_windows[job_id] = credit
+    try:
+        result = execute_command(command, send_chunk if job_id else None, max_output, job_id,
+                                 output_filter)
+    finally:
+        with credit_cond:
+            job_credits.pop(job_id, None)
+            job_windows.pop(job_id, None)
+    
+    # Send the output back
+    print(f"Sending output: {result['output'][:100]}...")
+    send_result("output", result.pop("output"), job_id=job_id, **result)
+
+def diff_lines(old, new):
+    """Encode ``new`` as a list of edit operations against ``old``.
+    
+    ``["=", i, j]`` copies ``old[i:j]`` and ``["+", lines]`` inserts new
+    lines; applying the operations in order rebuilds ``new``.
+    """
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old, new)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(["=", i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append(["+", new[j1:j2]])
+    return ops
+
+def run_watch_job(command, job_id, watch, max_output=WATCH_MAX_OUTPUT, output_filter=None,
+                  credit=None):
+    """Run one iteration of a watch and send its output as a diff when possible.
+    
+    A diff is only sent when the server holds the same previous output as we
+    do (its ``base_seq`` matches ours); otherwise, and every
+    WATCH_SNAPSHOT_EVERY runs, the full output is sent instead. Watch output
+    is collected locally rather than streamed, so ``credit`` is not used.
+    """
+    chunks = []
+    result = execute_command(command, lambda offset, data: chunks.append(data),
+                             min(max_output, WATCH_MAX_OUTPUT), job_id, output_filter)
+    output = result.pop("output")
+    if result["truncated"]:
+        output = b"".join(chunks).decode('utf-8', errors='replace')
+    lines = output.splitlines(keepends=True)
+    
+    watch_id = watch["id"]
+    state = watch_states.get(watch_id)
+    seq = state["seq"] + 1 if state else 1
+    if (state and watch.get("base_seq") == state["seq"]
+            and seq - state["snapshot_seq"] < WATCH_SNAPSHOT_EVERY):
+        data, base_seq, snapshot_seq = diff_lines(state["lines"], lines), state["seq"], state["snapshot_seq"]
+    else:
+        data, base_seq, snapshot_seq = output, None, seq
+    watch_states[watch_id] = {"seq": seq, "lines": lines, "snapshot_seq": snapshot_seq}
+    
+    result["truncated"] = result["total_bytes"] > result["spooled_bytes"]
+    send_result("output", data, job_id=job_id, watch_id=watch_id, seq=seq,
+                base_seq=base_seq, **result)
+
+def handle_server_message(sock, line):
+    """Parse and handle a single JSON line received from the server."""
+    try:
+        # Parse JSON message
+        print(f"Parsing JSON: {line[:200]}")
+        command_json = json.loads(line)
         
-        # Return the output
-        return result.stdout
-    except subprocess.TimeoutExpired:
-        return "Command timed out after 30 seconds"
+        # Handle command; jobs run in their own thread so that further
+        # messages, such as cancellations, are still received meanwhile
+        if command_json.get("type") == "command":
+            command = command_json.get("data", "")
+            print(f"Executing command: {command}")
+            if command_json.get("job_id"):
+                # Known from now on, so that a cancel arriving before the
+                # process is started still reaches it
+                with jobs_lock:
+                    running_jobs.setdefault(command_json["job_id"], None)
+            if command_json.get("watch"):
+                target = run_watch_job
+                args = (command, command_json.get("job_id"), command_json["watch"])
+            else:
+                target = run_job
+                args = (command, command_json.get("job_id"))
+            threading.Thread(
+                target=target,
+                args=args + (command_json.get("max_output") or MAX_OUTPUT_BYTES,
+                             command_json.get("filter"),
+                             command_json.get("credit")),
+                daemon=True
+            ).start()
+        elif command_json.get("type") == "cancel":
+            cancel_job(command_json.get("job_id"))
+        elif command_json.get("type") == "credit":
+            add_credit(command_json.get("job_id"), int(command_json.get("data", 0)))
+        elif command_json.get("type") == "unwatch":
+            watch_states.pop(command_json.get("watch_id"), None)
+    except json.JSONDecodeError as je:
+        print(f"Received invalid JSON: {line}")
+        print(f"JSON error: {je}")
+        send_message(sock, "error", f"Invalid JSON: {je}")
     except Exception as e:
-        return f"Error executing command: {e}"
+        print(f"Error processing message: {e}")
+        send_message(sock, "error", str(e))
 
 def connect_to_server(server_ip, server_port):
     """Connect to the server and handle communication."""
@@ -71,16 +719,42 @@ def connect_to_server(server_ip, server_port):
         sock.settimeout(10)  # 10 second timeout for connection
         sock.connect((server_ip, server_port))
         sock.settimeout(0.5)  # 0.5 second timeout for recv
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # SendBuffer batches instead
+        send_buffers[sock] = SendBuffer(sock)
         
-        client_socket = sock
         print(f"Connected to {server_ip}:{server_port}")
         
-        # Send system info
+        # Identify ourselves and send system info. The session lists the
+        # jobs still running here, so that the server can resume them after
+        # a reconnect, and results kept meanwhile are sent right after.
         system_info = f"{platform.node()} - {platform.system()} {platform.release()}"
-        send_message(sock, "info", f"Connected from {system_info}")
+        facts = collect_facts()
+        with jobs_lock:
+            session = {"running": list(running_jobs)}
+        send_message(sock, "hello", f"Connected from {system_info}", agent_id=AGENT_ID,
+                     facts=facts, session=session)
+        reset_credits()
+        with results_lock:
+            client_socket = sock
+        send_unsent_results(sock)
+        facts_checked = time.time()
         
         # Main communication loop
+        buffer = b""
         while running:
+            # A failed write leaves results unsent; reconnect to send them
+            if send_buffers[sock].error:
+                print(f"Send error: {send_buffers[sock].error}")
+                break
+            
+            # Report facts again when they change
+            if time.time() - facts_checked >= FACTS_INTERVAL:
+                facts_checked = time.time()
+                current_facts = collect_facts()
+                if current_facts != facts:
+                    facts = current_facts
+                    send_message(sock, "facts", facts)
+            
             try:
                 # Check for commands from server
                 data = sock.recv(4096)
@@ -88,40 +762,14 @@ def connect_to_server(server_ip, server_port):
                     print("Connection closed by server")
                     break
                 
-                # Process received data
-                data_str = data.decode('utf-8', errors='replace')
-                print(f"Raw data received: {data_str}")
-                
-                # Handle multiple messages or partial messages
-                buffer = ""
-                for char in data_str:
-                    buffer += char
-                    if char == '\n':
-                        if buffer.strip():
-                            try:
-                                # Parse JSON message
-                                print(f"Parsing JSON: {buffer.strip()}")
-                                command_json = json.loads(buffer.strip())
-                                
-                                # Handle command
-                                if command_json.get("type") == "command":
-                                    command = command_json.get("data", "")
-                                    print(f"Executing command: {command}")
-                                    
-                                    # Execute the command
-                                    output = execute_command(command)
-                                    
-                                    # Send the output back
-                                    print(f"Sending output: {output[:100]}...")
-                                    send_message(sock, "output", output)
-                            except json.JSONDecodeError as je:
-                                print(f"Received invalid JSON: {buffer.strip()}")
-                                print(f"JSON error: {je}")
-                                send_message(sock, "error", f"Invalid JSON: {je}")
-                            except Exception as e:
-                                print(f"Error processing message: {e}")
-                                send_message(sock, "error", str(e))
-                        buffer = ""
+                # Handle multiple messages or partial messages; an incomplete
+                # line stays in the buffer until the rest of it arrives
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    line = line.decode('utf-8', errors='replace').strip()
+                    if line:
+                        handle_server_message(sock, line)
             
             except socket.timeout:
                 # This is expected due to the timeout we set
@@ -136,6 +784,11 @@ def connect_to_server(server_ip, server_port):
             # Small delay to prevent CPU hogging
             time.sleep(0.01)
         
+        # Jobs still running keep their results until the next connection
+        buffer = send_buffers.pop(sock)
+        buffer.close()
+        sock.close()
+        print(f"Sent {buffer.flushed} messages in {buffer.send_calls} send calls")
         return False
     
     except ConnectionRefusedError:
@@ -4,37 +4,1311 @@ import queue
 import time
 import json
 import sys
-from flask import Flask, request, jsonify
+import os
+import uuid
+import base64
+import gzip
+import hashlib
+import mimetypes
+import collections
+import re
+import heapq
+import itertools
+import random
+import signal
+from simple_cron import parse_cron, next_cron_time
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Brotli variants are skipped when the package is missing
+
 # Create Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+app = Flask(__name__, static_folder=None)  # Static assets are served from a precompressed cache
+# Enable CORS for all routes; expose the paging headers of /jobs/<id>/output
+CORS(app, expose_headers=["X-Output-Offset", "X-Output-Size", "X-Next-Offset", "X-Job-Status"])
+
+# Flow control. While a consumer is polling /output and an agent's output
+# waiting in the queue grows past FEED_HIGH_WATER characters, the server
+# stops reading from that agent's socket until its backlog drains below
+# FEED_LOW_WATER; other agents are not affected. With no consumer the oldest
+# entries are dropped instead. Agents may have at most
+# JOB_CREDIT_WINDOW bytes of a job's output in flight, and get credit back
+# in CREDIT_BATCH steps once the server has spooled it.
+FEED_HIGH_WATER = 8 * 1024 * 1024
+FEED_LOW_WATER = 2 * 1024 * 1024
+CONSUMER_TIMEOUT = 30  # seconds since the last /output poll before the consumer counts as gone
+JOB_CREDIT_WINDOW = 1024 * 1024
+CREDIT_BATCH = 256 * 1024
+last_output_poll = 0
+
+def consumer_gone():
+    """Return whether nobody has polled /output for CONSUMER_TIMEOUT seconds."""
+    return time.time() - last_output_poll > CONSUMER_TIMEOUT
+
+class OutputQueue(queue.Queue):
+    """Queue of output for the web interface that keeps track of its size.
+    
+    Items are text, or (agent id, text) pairs for output coming from an
+    agent, so that the backlog of each agent is known; get() returns the
+    text only.
+    """
+    
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.chars = 0
+        self.dropped = 0
+        self.agent_chars = collections.Counter()
+    
+    def _put(self, item):
+        agent_id, text = item if isinstance(item, tuple) else (None, item)
+        super()._put((agent_id, text))
+        self.chars += len(text)
+        self.agent_chars[agent_id] += len(text)
+        if consumer_gone():
+            # Nobody is reading; keep memory bounded by dropping the oldest output
+            while self.chars > FEED_LOW_WATER and len(self.queue) > 1:
+                self.remove(*self.queue.popleft())
+                self.dropped += 1
+    
+    def _get(self):
+        agent_id, text = super()._get()
+        self.remove(agent_id, text)
+        return text
+    
+    def remove(self, agent_id, text):
+        """Take an item that left the queue off the size counts."""
+        self.chars -= len(text)
+        self.agent_chars[agent_id] -= len(text)
+        if not self.agent_chars[agent_id]:
+            del self.agent_chars[agent_id]
+    
+    def backlog(self, agent_id):
+        """Return the characters of an agent's output waiting in the queue."""
+        with self.mutex:
+            return self.agent_chars.get(agent_id, 0)
 
-# Queues for communication
-command_queue = queue.Queue()
-output_queue = queue.Queue()
+# Queue of output shown in the web interface
+output_queue = OutputQueue()
 
-# Connection state
-client_connected = False
-client_info = None
+# Connection state; agents are keyed by the id they report in their hello
+# message, or by their address if they do not send one
+agents = {}
+current_agent_id = None  # most recently connected agent, the default target
 server_running = True
-client_lock = threading.Lock()
+agents_lock = threading.Lock()
+HELLO_TIMEOUT = 5  # seconds to wait for a client's hello message
+
+# Agent link I/O. Messages queued for an agent during one pass of its
+# handler loop are written together with a single vectored send, and
+# TCP_NODELAY is set so the kernel does not hold the batch back waiting for
+# ACKs. The counters cover all agent connections and are shown by /status.
+RECV_BYTES = 256 * 1024
+MAX_IOV = 1024  # buffers passed to one sendmsg() call (IOV_MAX on Linux and BSD)
+link_stats = collections.Counter()
+link_stats_lock = threading.Lock()
+
+# Inventory of every agent seen since startup, guarded by agents_lock. The
+# index maps (fact, value) pairs, and ("label", label) pairs, to agent ids
+# so that /agents queries are set lookups.
+inventory = {}
+inventory_index = collections.defaultdict(set)
 
 # Socket server
 server_socket = None
-client_socket = None
+
+# Job store; full command output is spooled to disk, one file per job.
+# job_events is notified whenever a job finishes or gets more output, so
+# that requests with ``wait`` can long-poll instead of busy-polling.
+jobs = {}
+jobs_lock = threading.Lock()
+job_events = threading.Condition(jobs_lock)
+MAX_WAIT = 30  # longest a request may wait for a job, in seconds
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool")
+DEFAULT_MAX_OUTPUT = 64 * 1024 * 1024  # bytes spooled per job
+DEFAULT_PAGE_SIZE = 64 * 1024  # bytes returned by /jobs/<id>/output by default
+MAX_PAGE_SIZE = 1024 * 1024  # largest range served by /jobs/<id>/output
+JOB_HISTORY_LIMIT = 1000  # finished jobs kept before the oldest are pruned
+
+# Scheduler state, guarded by jobs_lock. Each agent has one queue per
+# priority class; a queue maps submitters to their pending jobs and is
+# served round-robin so one submitter cannot starve the others.
+PRIORITIES = ("interactive", "batch")  # served in this order
+MAX_INFLIGHT_PER_AGENT = 2  # jobs running concurrently on one agent
+agent_queues = {}
+
+# Watches: commands re-run on an agent at a fixed interval, guarded by
+# jobs_lock. Agents send each run as a diff against the previous one and the
+# server keeps the reconstructed output of the latest run.
+watches = {}
+MIN_WATCH_INTERVAL = 1  # seconds
+SUMMARY_HEAD_CHARS = 16 * 1024  # characters of a reconstructed output kept in its job
+SUMMARY_TAIL_CHARS = 16 * 1024
+
+# Timers for watches and recurring schedules. The heap holds
+# (due, counter, kind, id) entries and the timer thread sleeps until the
+# earliest one, so idle schedules cost nothing between runs.
+timer_heap = []
+timer_counter = itertools.count()
+timer_lock = threading.Condition()
+
+# Recurring schedules, guarded by jobs_lock
+schedules = {}
+MISSED_RUN_POLICIES = ("run_once", "run_all", "skip")
+OVERLAP_POLICIES = ("skip", "queue", "cancel")
+MISFIRE_GRACE = 5  # seconds a run may be late before it counts as missed
+MAX_CATCHUP_RUNS = 10  # missed runs replayed at most by the run_all policy
+
+# Resource usage reported by agents with job results, totalled per agent
+# and per command, guarded by jobs_lock. Only the most recently run
+# commands are kept so that one-off commands cannot grow the table forever.
+USAGE_COMMAND_LIMIT = 1000
+USAGE_SORT_KEYS = ("cpu_time", "wall_time", "max_rss", "jobs")
+agent_usage = {}
+command_usage = collections.OrderedDict()
+
+# Fan-outs: one command run on many agents, with the results grouped by
+# identical output, guarded by jobs_lock. Each job's output is hashed as it
+# is spooled and only one copy of each distinct output is kept, so memory
+# grows with the number of distinct results rather than with the number of
+# agents.
+fanouts = {}
+fanout_digests = {}  # job id -> OutputDigest of a fan-out job still running
+FANOUT_HISTORY_LIMIT = 100  # fan-outs kept before the oldest are forgotten
+DEFAULT_FANOUT_TIMEOUT = 300  # seconds before unfinished jobs count as timed out
+NORMALIZE_MAX_LINE = 1024 * 1024  # longer lines are split when normalizing
+
+# Graceful shutdown. While draining no new jobs are accepted or dispatched,
+# and running jobs get up to DRAIN_TIMEOUT seconds to report back. The
+# server state is then written to SNAPSHOT_PATH and loaded again on the
+# next start.
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_state.json")
+DRAIN_TIMEOUT = 30
+draining = False
+drain_deadline = None  # when the wait for running jobs ends, once shutting down
+
+# Web interface assets, loaded and precompressed once at startup
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_CACHE_CONTROL = {".html": "no-cache"}  # HTML is always revalidated with its ETag
+DEFAULT_STATIC_CACHE_CONTROL = "public, max-age=3600"
+static_assets = {}
+
+def create_job(command, agent_id, max_output=None, priority="interactive",
+               submitter=None, deadline=None, output_filter=None, watch_id=None,
+               schedule_id=None, fanout_id=None):
+    """Create a job record for a command and queue it for an agent."""
+    job_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    job = {
+        "id": job_id,
+        "command": command,
+        "agent": agent_id,
+        "priority": priority,
+        "submitter": submitter,
+        "status": "queued",
+        "created": now,
+        "deadline": now + deadline if deadline else None,
+        "started": None,
+        "finished": None,
+        "max_output": max_output or DEFAULT_MAX_OUTPUT,
+        "filter": output_filter,
+        "watch": watch_id,
+        "schedule": schedule_id,
+        "fanout": fanout_id,
+        "total_bytes": 0,
+        "spooled_bytes": 0,
+        "uncredited": 0,  # bytes spooled but not yet credited back to the agent
+        "truncated": False,
+        "incomplete": False,  # output chunks were lost, so the spool has gaps
+        "usage": None,  # resource usage reported with the result
+        "result": None
+    }
+    with jobs_lock:
+        jobs[job_id] = job
+        queues = agent_queues.setdefault(agent_id, new_agent_queues())
+        queues[priority].setdefault(submitter, collections.deque()).append(job)
+    return job
+
+def parse_output_filter(spec):
+    """Validate the output filter of a job request.
+    
+    Returns the filter to send to the agent, or None if there is none.
+    Raises ValueError if the filter is malformed.
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError("'filter' must be an object")
+    
+    output_filter = {}
+    for key in ("include", "exclude"):
+        if spec.get(key):
+            try:
+                re.compile(spec[key])
+            except re.error as e:
+                raise ValueError(f"Invalid '{key}' pattern: {e}")
+            output_filter[key] = spec[key]
+    for key in ("head", "tail", "max_bytes"):
+        if spec.get(key) is not None:
+            if not isinstance(spec[key], int) or spec[key] <= 0:
+                raise ValueError(f"'{key}' must be a positive integer")
+            output_filter[key] = spec[key]
+    return output_filter or None
+
+def parse_selector(spec):
+    """Turn a selector object such as ``{"os": "Linux", "label": ["a", "b"]}``
+    into the (fact, value) filters taken by select_agents().
+    
+    Raises ValueError if the selector is malformed.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("'selector' must be an object of facts")
+    selector = []
+    for key, value in spec.items():
+        values = value if isinstance(value, list) else [value]
+        selector.extend((key, item) for item in values)
+    return selector
+
+def parse_agent_ids(spec):
+    """Validate a list of agent ids given in a request.
+    
+    Raises ValueError unless it is a non-empty list of strings.
+    """
+    if (not isinstance(spec, list) or not spec
+            or not all(isinstance(agent_id, str) and agent_id for agent_id in spec)):
+        raise ValueError("'agents' must be a list of agent ids")
+    return list(spec)
+
+def parse_normalize(spec):
+    """Validate the output normalization of a fan-out request.
+    
+    Returns the normalization options, or None if there are none. Raises
+    ValueError if they are malformed.
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError("'normalize' must be an object")
+    
+    normalize = {key: True for key in ("whitespace", "case") if spec.get(key)}
+    masks = spec.get("mask") or []
+    if isinstance(masks, str):
+        masks = [masks]
+    for pattern in masks:
+        if not isinstance(pattern, str):
+            raise ValueError("'mask' must be a pattern or a list of patterns")
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Invalid 'mask' pattern: {e}")
+    if masks:
+        normalize["mask"] = masks
+    return normalize or None
+
+def new_agent_queues():
+    """Return empty scheduler state for an agent."""
+    queues = {priority: collections.OrderedDict() for priority in PRIORITIES}
+    queues["running"] = set()
+    return queues
+
+def next_job(agent_id):
+    """Take the next job to run on an agent, or None.
+    
+    Interactive jobs always go before batch jobs. Within a priority class the
+    submitters take turns, one job each. Jobs that were cancelled or expired
+    while queued are dropped here.
+    """
+    if draining:
+        return None
+    
+    now = time.time()
+    with jobs_lock:
+        queues = agent_queues.get(agent_id)
+        if not queues or len(queues["running"]) >= MAX_INFLIGHT_PER_AGENT:
+            return None
+        
+        for priority in PRIORITIES:
+            submitters = queues[priority]
+            while submitters:
+                submitter, pending = next(iter(submitters.items()))
+                job = pending.popleft()
+                if pending:
+                    submitters.move_to_end(submitter)
+                else:
+                    del submitters[submitter]
+                
+                if job["status"] == "queued" and job["deadline"] and job["deadline"] <= now:
+                    expire_job(job, now)
+                if job["status"] != "queued":
+                    continue
+                
+                job["status"] = "running"
+                job["started"] = now
+                queues["running"].add(job["id"])
+                return job
+    return None
+
+def expire_job(job, now):
+    """Mark a queued job whose deadline passed as expired. Caller holds jobs_lock."""
+    job["status"] = "expired"
+    job["finished"] = now
+    job_events.notify_all()
+    output_queue.put(f"Job {job['id']} expired before it could run: {job['command']}\n")
+
+def expire_jobs():
+    """Expire queued jobs whose deadline has passed."""
+    now = time.time()
+    with jobs_lock:
+        for job in jobs.values():
+            if job["status"] == "queued" and job["deadline"] and job["deadline"] <= now:
+                expire_job(job, now)
+
+def queued_job_count(agent_id=None):
+    """Count the jobs waiting to be dispatched, for one agent or all of them."""
+    with jobs_lock:
+        return sum(1 for job in jobs.values()
+                   if job["status"] == "queued" and agent_id in (None, job["agent"]))
+
+def queued_job_counts():
+    """Count the jobs waiting to be dispatched, per agent."""
+    with jobs_lock:
+        return collections.Counter(job["agent"] for job in jobs.values()
+                                   if job["status"] == "queued")
+
+def spool_path(job_id):
+    """Return the path of the spool file holding a job's full output."""
+    return os.path.join(SPOOL_DIR, f"{job_id}.out")
+
+def job_summary(job):
+    """Return the public view of a job record."""
+    return {key: value for key, value in job.items() if key != "result"}
+
+def append_job_output(job_id, offset, data):
+    """Write a chunk of a job's output to its spool file at the given offset."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if not job:
+        print(f"[Server] Dropping output chunk for unknown job {job_id}")
+        return
+    
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = spool_path(job_id)
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.seek(offset)
+        f.write(data)
+    
+    # Fan-out jobs are hashed as their output arrives
+    digest = fanout_digests.get(job_id)
+    if digest:
+        digest.update(offset, data)
+    
+    with jobs_lock:
+        if offset > job["spooled_bytes"]:
+            # Chunks sent while the link was down are not resent
+            job["incomplete"] = True
+        job["spooled_bytes"] = max(job["spooled_bytes"], offset + len(data))
+        job["uncredited"] += len(data)
+        job_events.notify_all()
+
+def feed_paused(agent_id, paused):
+    """Return whether to stop reading from an agent, given whether we already have.
+    
+    Only an agent whose own output piles up in the queue is paused, and only
+    while a consumer is polling /output. Reading stops above the high-water
+    mark and resumes below the low-water mark, so a consumer catching up
+    does not make agents flap.
+    """
+    if consumer_gone():
+        return False
+    if paused:
+        return output_queue.backlog(agent_id) > FEED_LOW_WATER
+    return output_queue.backlog(agent_id) > FEED_HIGH_WATER
+
+def take_credits(agent_id):
+    """Collect the credit to give back to an agent for its running jobs.
+    
+    Returns (job_id, bytes) pairs; credit is handed out in batches of at
+    least CREDIT_BATCH bytes to keep the number of messages down.
+    """
+    grants = []
+    with jobs_lock:
+        queues = agent_queues.get(agent_id)
+        for job_id in queues["running"] if queues else ():
+            job = jobs.get(job_id)
+            if job and job["uncredited"] >= CREDIT_BATCH:
+                grants.append((job_id, job["uncredited"]))
+                job["uncredited"] = 0
+    return grants
+
+def finish_job(job_id, status, response):
+    """Record the final result reported by the client for a job, and return the job."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if not job:
+            return
+        if response.get("cancelled"):
+            status = "cancelled"
+        job["status"] = status
+        job["finished"] = time.time()
+        job["result"] = response.get("data", "")
+        job["total_bytes"] = response.get("total_bytes", 0)
+        job["truncated"] = response.get("truncated", False)
+        if response.get("spooled_bytes", 0) > job["spooled_bytes"]:
+            job["incomplete"] = True  # the last chunks never arrived
+        if isinstance(response.get("usage"), dict):
+            job["usage"] = response["usage"]
+            record_usage(job)
+        job_events.notify_all()
+        agent_queues.get(job["agent"], new_agent_queues())["running"].discard(job_id)
+    if job.get("fanout"):
+        record_fanout_result(job)
+    prune_jobs()
+    return job
+
+def new_usage_totals():
+    """Return empty resource usage totals."""
+    return {
+        "jobs": 0,
+        "failed": 0,  # jobs that exited with a non-zero code
+        "wall_time": 0.0,
+        "user_time": 0.0,
+        "system_time": 0.0,
+        "max_rss": 0,  # largest peak memory of any job
+        "bytes_read": 0,
+        "last_run": None
+    }
+
+def record_usage(job):
+    """Add the resource usage of a finished job to its agent's and command's totals.
+    
+    Caller holds jobs_lock.
+    """
+    usage = job["usage"]
+    if job["command"] in command_usage:
+        command_usage.move_to_end(job["command"])
+    elif len(command_usage) >= USAGE_COMMAND_LIMIT:
+        command_usage.popitem(last=False)
+    
+    for totals in (agent_usage.setdefault(job["agent"], new_usage_totals()),
+                   command_usage.setdefault(job["command"], new_usage_totals())):
+        totals["jobs"] += 1
+        if usage.get("exit_code"):
+            totals["failed"] += 1
+        for key in ("wall_time", "user_time", "system_time", "bytes_read"):
+            totals[key] += usage.get(key) or 0
+        totals["max_rss"] = max(totals["max_rss"], usage.get("max_rss") or 0)
+        totals["last_run"] = job["finished"]
+
+def usage_summary(totals):
+    """Return usage totals with the CPU time and per-job averages added."""
+    summary = dict(totals)
+    summary["cpu_time"] = totals["user_time"] + totals["system_time"]
+    summary["avg_wall_time"] = totals["wall_time"] / totals["jobs"]
+    summary["avg_cpu_time"] = summary["cpu_time"] / totals["jobs"]
+    return summary
+
+def summarize_text(text):
+    """Shorten a reconstructed output to its head and tail for a job record."""
+    if len(text) <= SUMMARY_HEAD_CHARS + SUMMARY_TAIL_CHARS:
+        return text
+    omitted = len(text) - SUMMARY_HEAD_CHARS - SUMMARY_TAIL_CHARS
+    return (text[:SUMMARY_HEAD_CHARS] + f"\n... [{omitted} characters truncated] ...\n"
+            + text[-SUMMARY_TAIL_CHARS:])
+
+def create_watch(command, agent_id, interval, output_filter=None):
+    """Create a watch that re-runs a command on an agent every ``interval`` seconds."""
+    watch_id = uuid.uuid4().hex[:12]
+    watch = {
+        "id": watch_id,
+        "command": command,
+        "agent": agent_id,
+        "interval": interval,
+        "filter": output_filter,
+        "created": time.time(),
+        "next_run": time.time(),
+        "job": None,  # id of the job for the current run
+        "runs": 0,
+        "seq": None,  # sequence number of the output held in "lines"
+        "lines": [],
+        "updated": None,
+        "bytes_received": 0,  # payload bytes actually received from the agent
+        "bytes_reconstructed": 0  # bytes the agent would have sent without diffs
+    }
+    with jobs_lock:
+        watches[watch_id] = watch
+    add_timer(watch["next_run"], "watch", watch_id)
+    return watch
+
+def run_watch(watch_id, due):
+    """Timer handler: queue the next run of a watch and set its next timer.
+    
+    A run is skipped while the previous one has not finished, so a slow
+    command never piles up jobs.
+    """
+    with jobs_lock:
+        watch = watches.get(watch_id)
+        if not watch:
+            return
+        busy = watch["job"] and jobs.get(watch["job"], {}).get("finished") is None
+        watch["next_run"] = max(due + watch["interval"], time.time())
+    add_timer(watch["next_run"], "watch", watch_id)
+    
+    if busy:
+        return
+    job = create_job(watch["command"], watch["agent"], priority="batch",
+                     submitter=f"watch:{watch_id}", output_filter=watch["filter"],
+                     watch_id=watch_id)
+    with jobs_lock:
+        watch["job"] = job["id"]
+
+def add_timer(due, kind, item_id):
+    """Arrange for the timer handler of ``kind`` to be called for an item at ``due``."""
+    with timer_lock:
+        heapq.heappush(timer_heap, (due, next(timer_counter), kind, item_id))
+        if timer_heap[0][3] == item_id:
+            # The new timer is the earliest one; wake the timer thread
+            timer_lock.notify()
+
+def timer_loop():
+    """Run watch and schedule timers as they come due."""
+    while server_running:
+        with timer_lock:
+            while server_running and (not timer_heap or timer_heap[0][0] > time.time()):
+                timer_lock.wait(timer_heap[0][0] - time.time() if timer_heap else None)
+            if not server_running:
+                break
+            due, _, kind, item_id = heapq.heappop(timer_heap)
+        
+        # Timers of deleted watches and schedules are dropped by their handlers
+        try:
+            TIMER_HANDLERS[kind](item_id, due)
+        except Exception as e:
+            print(f"[Server] Error running {kind} {item_id}: {e}")
+
+def stop_timers():
+    """Wake the timer thread so that it notices the server is stopping."""
+    with timer_lock:
+        timer_lock.notify_all()
+
+def next_occurrence(schedule, after):
+    """Return the nominal time of a schedule's first run after ``after``."""
+    if schedule["cron"]:
+        return next_cron_time(parse_cron(schedule["cron"]), after)
+    return after + schedule["interval"]
+
+def create_schedule(command, targets, interval=None, cron=None, jitter=0,
+                    missed="run_once", overlap="skip", priority="batch",
+                    output_filter=None, max_output=None):
+    """Create a recurring schedule and set its first timer.
+    
+    ``targets`` is either {"agents": [ids]} or {"selector": [(fact, value)]};
+    a selector is resolved against the inventory on every run.
+    """
+    schedule_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    schedule = {
+        "id": schedule_id,
+        "command": command,
+        "agents": targets.get("agents"),
+        "selector": targets.get("selector"),
+        "interval": interval,
+        "cron": cron,
+        "jitter": jitter,
+        "missed": missed,
+        "overlap": overlap,
+        "priority": priority,
+        "filter": output_filter,
+        "max_output": max_output,
+        "created": now,
+        "next_run": None,  # nominal time of the next run, before jitter
+        "last_run": None,
+        "runs": 0,
+        "missed_runs": 0,
+        "skipped_runs": 0,  # runs not started on an agent because of the overlap policy
+        "jobs": {}  # agent id -> id of its latest job
+    }
+    schedule["next_run"] = now if interval else next_occurrence(schedule, now)
+    with jobs_lock:
+        schedules[schedule_id] = schedule
+    add_timer(schedule["next_run"] + random.uniform(0, jitter), "schedule", schedule_id)
+    return schedule
+
+def run_schedule(schedule_id, due):
+    """Timer handler: start the runs of a schedule that are due and set its next timer.
+    
+    When the server fell behind, the runs that were missed are handled
+    according to the schedule's policy: ``run_once`` coalesces them into a
+    single run, ``run_all`` replays them (up to MAX_CATCHUP_RUNS) and
+    ``skip`` drops everything that is more than MISFIRE_GRACE seconds late.
+    """
+    now = time.time()
+    with jobs_lock:
+        schedule = schedules.get(schedule_id)
+        if not schedule:
+            return
+        
+        occurrences = [schedule["next_run"]]
+        following = next_occurrence(schedule, occurrences[-1])
+        while following <= now:
+            if len(occurrences) <= MAX_CATCHUP_RUNS:
+                occurrences.append(following)
+                following = next_occurrence(schedule, following)
+            else:
+                # Far behind; jump straight to the first run after now
+                following = next_occurrence(schedule, now)
+        
+        late = now - occurrences[-1] > MISFIRE_GRACE + schedule["jitter"]
+        if len(occurrences) > 1 or late:
+            schedule["missed_runs"] += len(occurrences) - (0 if late else 1)
+        
+        if schedule["missed"] == "skip":
+            runs = 0 if late else 1
+        elif schedule["missed"] == "run_all":
+            runs = len(occurrences)
+        else:
+            runs = 1
+        schedule["next_run"] = following
+    add_timer(following + random.uniform(0, schedule["jitter"]), "schedule", schedule_id)
+    
+    for _ in range(runs):
+        start_schedule_run(schedule)
+
+def start_schedule_run(schedule):
+    """Queue one run of a schedule on each of its connected target agents.
+    
+    Agents that are not connected are skipped, and a job that has not
+    started by the next run expires, so runs do not pile up for agents
+    that are away or busy.
+    """
+    if schedule["selector"] is not None:
+        targets = select_agents(schedule["selector"], connected_only=True)
+    else:
+        with agents_lock:
+            targets = [agent_id for agent_id in schedule["agents"] if agent_id in agents]
+        with jobs_lock:
+            schedule["skipped_runs"] += len(schedule["agents"]) - len(targets)
+    deadline = max(schedule["next_run"] - time.time(), 1)
+    
+    for agent_id in targets:
+        with jobs_lock:
+            previous = jobs.get(schedule["jobs"].get(agent_id))
+            busy = previous is not None and previous["finished"] is None
+            if busy and schedule["overlap"] == "skip":
+                schedule["skipped_runs"] += 1
+                continue
+        if busy and schedule["overlap"] == "cancel":
+            cancel_job(previous["id"])
+        
+        job = create_job(schedule["command"], agent_id,
+                         max_output=schedule["max_output"],
+                         priority=schedule["priority"],
+                         submitter=f"schedule:{schedule['id']}",
+                         deadline=deadline,
+                         output_filter=schedule["filter"],
+                         schedule_id=schedule["id"])
+        with jobs_lock:
+            schedule["jobs"][agent_id] = job["id"]
+    
+    with jobs_lock:
+        schedule["runs"] += 1
+        schedule["last_run"] = time.time()
+
+class OutputDigest:
+    """SHA-256 of a job's output, computed chunk by chunk as it is spooled.
+    
+    With normalization the output is hashed line by line after masking
+    patterns, lowercasing and collapsing whitespace, so outputs that only
+    differ in those respects get the same digest.
+    """
+    
+    def __init__(self, normalize=None):
+        self.normalize = normalize
+        self.masks = [re.compile(pattern.encode('utf-8'))
+                      for pattern in (normalize or {}).get("mask", [])]
+        self.hash = hashlib.sha256()
+        self.partial = b""  # start of a line still to come
+        self.offset = 0
+        self.in_order = True  # False once a chunk arrived out of order
+    
+    def update(self, offset, data):
+        """Hash the next chunk of output."""
+        if offset != self.offset:
+            self.in_order = False
+        if not self.in_order:
+            return
+        self.offset += len(data)
+        if not self.normalize:
+            self.hash.update(data)
+            return
+        
+        # Very long lines are cut at fixed positions, wherever the chunks end
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            for start in range(0, max(len(line), 1), NORMALIZE_MAX_LINE):
+                self.add_line(line[start:start + NORMALIZE_MAX_LINE])
+        while len(self.partial) > NORMALIZE_MAX_LINE:
+            self.add_line(self.partial[:NORMALIZE_MAX_LINE])
+            self.partial = self.partial[NORMALIZE_MAX_LINE:]
+    
+    def add_line(self, line):
+        """Hash one line of output after normalizing it."""
+        for pattern in self.masks:
+            line = pattern.sub(b"#", line)
+        if self.normalize.get("case"):
+            line = line.lower()
+        if self.normalize.get("whitespace"):
+            line = b" ".join(line.split())
+            if not line:
+                return  # blank lines are ignored
+        self.hash.update(line + b"\n")
+    
+    def hexdigest(self):
+        """Return the digest of all the output hashed so far."""
+        if self.normalize and self.partial:
+            self.add_line(self.partial)
+            self.partial = b""
+        return self.hash.hexdigest()
+
+def create_fanout(command, agent_ids, normalize=None, timeout=DEFAULT_FANOUT_TIMEOUT,
+                  priority="interactive", submitter=None, output_filter=None, max_output=None):
+    """Queue a command on every agent in ``agent_ids`` and collect the results as one fan-out."""
+    fanout_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    fanout = {
+        "id": fanout_id,
+        "command": command,
+        "created": now,
+        "deadline": now + timeout,
+        "normalize": normalize,
+        "targets": len(agent_ids),
+        "pending": set(),  # ids of jobs whose result is not in yet
+        "timed_out": set(),  # ids of jobs given up on at the deadline
+        "groups": {},  # "digest:exit code" -> agents with that output
+        "statuses": {},  # status -> agents whose job ended without output
+        "announced": False  # whether the summary was posted to the output feed
+    }
+    with jobs_lock:
+        fanouts[fanout_id] = fanout
+        while len(fanouts) > FANOUT_HISTORY_LIMIT:
+            expired = fanouts.pop(next(iter(fanouts)))
+            for job_id in expired["pending"]:
+                fanout_digests.pop(job_id, None)
+    
+    for agent_id in agent_ids:
+        job = create_job(command, agent_id, max_output=max_output, priority=priority,
+                         submitter=submitter, output_filter=output_filter, fanout_id=fanout_id)
+        with jobs_lock:
+            fanout["pending"].add(job["id"])
+            fanout_digests[job["id"]] = OutputDigest(normalize)
+    add_timer(fanout["deadline"], "fanout", fanout_id)
+    return fanout
+
+def job_output_digest(job, normalize):
+    """Return the digest of a finished job's output.
+    
+    The digest computed while the output arrived is used when it covers all
+    of it; otherwise, e.g. after a reconnect or a restart, the spool file is
+    hashed instead.
+    """
+    digest = fanout_digests.pop(job["id"], None)
+    if digest and digest.in_order and digest.offset == job["spooled_bytes"]:
+        return digest.hexdigest()
+    
+    digest = OutputDigest(normalize)
+    try:
+        with open(spool_path(job["id"]), "rb") as f:
+            for data in iter(lambda: f.read(DEFAULT_PAGE_SIZE), b""):
+                digest.update(digest.offset, data)
+    except FileNotFoundError:
+        pass
+    return digest.hexdigest()
+
+def record_fanout_result(job):
+    """Add a finished job to its fan-out, grouping it with the same output when it ran."""
+    with jobs_lock:
+        fanout = fanouts.get(job["fanout"])
+        if not fanout or job["id"] not in fanout["pending"]:
+            return
+        normalize = fanout["normalize"]
+    
+    digest = None
+    if job["status"] == "done" and not job.get("incomplete"):
+        digest = job_output_digest(job, normalize)
+    else:
+        fanout_digests.pop(job["id"], None)
+    
+    with jobs_lock:
+        if job["id"] not in fanout["pending"]:
+            return
+        fanout["pending"].discard(job["id"])
+        if digest is None:
+            if job["id"] in fanout["timed_out"]:
+                status = "timed_out"
+            elif job.get("incomplete"):
+                status = "incomplete"  # the output cannot be compared
+            else:
+                status = job["status"]
+            fanout["statuses"].setdefault(status, []).append(job["agent"])
+        else:
+            exit_code = (job["usage"] or {}).get("exit_code")
+            key = f"{digest}:{exit_code}"
+            group = fanout["groups"].get(key)
+            if group is None:
+                group = fanout["groups"][key] = {
+                    "digest": digest,
+                    "exit_code": exit_code,
+                    "job": job["id"],  # the job whose output is kept
+                    "output": job["result"],
+                    "agents": []
+                }
+            else:
+                job["result"] = None  # the group holds the output
+            job["output_group"] = key
+            group["agents"].append(job["agent"])
+        job_events.notify_all()
+    announce_fanout(fanout)
+
+def expire_fanout(fanout_id, due):
+    """Timer handler: give up on the jobs of a fan-out that did not finish in time."""
+    with jobs_lock:
+        fanout = fanouts.get(fanout_id)
+        if not fanout:
+            return
+        late = [job_id for job_id in fanout["pending"]
+                if job_id in jobs and jobs[job_id]["finished"] is None]
+        fanout["timed_out"].update(late)
+        job_events.notify_all()
+    
+    for job_id in late:
+        cancel_job(job_id)
+    announce_fanout(fanout)
+
+def fanout_complete(fanout):
+    """Return whether every job of a fan-out has a result or was given up on.
+    
+    Caller holds jobs_lock.
+    """
+    return not any(job_id in jobs and jobs[job_id]["finished"] is None
+                   and job_id not in fanout["timed_out"] for job_id in fanout["pending"])
+
+def announce_fanout(fanout):
+    """Post a fan-out's summary line to the output feed once it is complete."""
+    with jobs_lock:
+        if fanout["announced"] or not fanout_complete(fanout):
+            return
+        fanout["announced"] = True
+        summary = fanout_summary(fanout, detail=False)
+    output_queue.put(f"Fan-out {fanout['id']} ({fanout['command']}): {summary['summary']}\n")
+
+def fanout_summary(fanout, detail=True):
+    """Return the public view of a fan-out. Caller holds jobs_lock.
+    
+    Groups are labelled A, B, ... from the most common output down. Jobs
+    whose result is not in yet are counted by their current status.
+    """
+    statuses = {status: list(agent_ids) for status, agent_ids in fanout["statuses"].items()}
+    for job_id in fanout["pending"]:
+        job = jobs.get(job_id)
+        if job_id in fanout["timed_out"]:
+            status = "timed_out"
+        elif not job:
+            status = "lost"
+        elif job["finished"] is None:
+            status = "pending"
+        else:
+            status = job["status"]
+        statuses.setdefault(status, []).append(job["agent"] if job else None)
+    
+    groups = sorted(fanout["groups"].values(), key=lambda group: len(group["agents"]),
+                    reverse=True)
+    parts = []
+    group_list = []
+    for index, group in enumerate(groups):
+        label = chr(ord("A") + index) if index < 26 else str(index + 1)
+        count = len(group["agents"])
+        exit_note = f" (exit {group['exit_code']})" if group["exit_code"] else ""
+        parts.append(f"{count} host{'s' if count != 1 else ''}: output {label}{exit_note}")
+        entry = {key: value for key, value in group.items() if key != "agents"}
+        entry.update(label=label, count=count)
+        if detail:
+            entry["agents"] = group["agents"]
+        else:
+            del entry["output"]
+        group_list.append(entry)
+    for status, agent_ids in sorted(statuses.items(), key=lambda item: -len(item[1])):
+        parts.append(f"{len(agent_ids)} {status.replace('_', ' ')}")
+    
+    summary = {key: value for key, value in fanout.items()
+               if key not in ("pending", "timed_out", "groups", "statuses", "announced")}
+    summary.update({
+        "complete": "pending" not in statuses,
+        "summary": ", ".join(parts) or "no hosts",
+        "groups": group_list,
+        "statuses": statuses if detail else {status: len(ids) for status, ids in statuses.items()}
+    })
+    return summary
+
+TIMER_HANDLERS = {
+    "watch": run_watch,
+    "schedule": run_schedule,
+    "fanout": expire_fanout
+}
+
+def apply_watch_output(watch_id, response):
+    """Rebuild the full output of a watch run from the agent's diff.
+    
+    Returns the output text and whether it differs from the previous run.
+    The text is None if the diff is against an output the server no longer
+    holds; the next run then asks for a full snapshot.
+    """
+    data = response.get("data", "")
+    with jobs_lock:
+        watch = watches.get(watch_id)
+        if not watch:
+            return (None if response.get("base_seq") is not None else data), True
+        
+        if response.get("base_seq") is None:
+            lines = data.splitlines(keepends=True)
+        elif response.get("base_seq") == watch["seq"]:
+            lines = []
+            for op in data:
+                if op[0] == "=":
+                    lines.extend(watch["lines"][op[1]:op[2]])
+                else:
+                    lines.extend(op[1])
+        else:
+            watch["seq"] = None
+            return None, True
+        
+        changed = lines != watch["lines"]
+        text = "".join(lines)
+        watch["seq"] = response.get("seq")
+        watch["lines"] = lines
+        watch["runs"] += 1
+        watch["updated"] = time.time()
+        watch["bytes_received"] += len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        watch["bytes_reconstructed"] += len(text.encode('utf-8'))
+    return text, changed
+
+def finish_watch_job(job_id, watch_id, response):
+    """Record the result of a watch run, storing the rebuilt output in the job's spool."""
+    text, changed = apply_watch_output(watch_id, response)
+    if text is None:
+        finish_job(job_id, "error", {"data": "Watch diff against an unknown base; "
+                                             "requesting a full snapshot"})
+        return
+    
+    data = text.encode('utf-8')
+    append_job_output(job_id, 0, data)
+    finish_job(job_id, "done", dict(response, data=summarize_text(text), total_bytes=len(data)))
+    
+    if changed:
+        output_queue.put(f"Watch {watch_id} run {response.get('seq')}: output changed\n")
+
+def watch_summary(watch):
+    """Return the public view of a watch."""
+    return {key: value for key, value in watch.items() if key != "lines"}
+
+def cancel_job(job_id):
+    """Cancel a queued or running job. Returns the job, or None if unknown."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if not job:
+            return None
+        if job["status"] == "queued":
+            # The scheduler drops it from its queue when it comes up
+            job["status"] = "cancelled"
+            job["finished"] = time.time()
+            job_events.notify_all()
+            return job
+        if job["status"] != "running":
+            return job
+        job["status"] = "cancelling"
+    
+    with agents_lock:
+        agent = agents.get(job["agent"])
+    if agent:
+        agent["outbox"].put({"type": "cancel", "data": "", "job_id": job_id})
+    return job
+
+def wait_for_job(job, timeout, ready):
+    """Wait up to ``timeout`` seconds, at most MAX_WAIT, until ``ready(job)`` holds.
+    
+    Also used for fan-outs, whose progress is signalled the same way. Caller
+    holds jobs_lock, which is released while waiting.
+    """
+    deadline = time.time() + min(timeout, MAX_WAIT)
+    while not ready(job):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        job_events.wait(remaining)
+
+def prune_jobs():
+    """Drop the oldest finished jobs, and their spool files, beyond the history limit."""
+    with jobs_lock:
+        finished = [job for job in jobs.values() if job["finished"]]
+        excess = len(finished) - JOB_HISTORY_LIMIT
+        if excess <= 0:
+            return
+        finished.sort(key=lambda job: job["finished"])
+        expired = [job["id"] for job in finished[:excess]]
+        for job_id in expired:
+            del jobs[job_id]
+    
+    for job_id in expired:
+        try:
+            os.remove(spool_path(job_id))
+        except OSError:
+            pass
+
+def fact_index_keys(facts):
+    """Yield the inventory index keys for a set of facts."""
+    for key, value in facts.items():
+        if key == "labels":
+            for label in value or []:
+                yield ("label", str(label).lower())
+        elif value is not None and not isinstance(value, (dict, list)):
+            yield (key, str(value).lower())
+
+def update_facts(agent_id, facts):
+    """Store the facts reported by an agent and re-index them."""
+    if not isinstance(facts, dict):
+        return
+    
+    with agents_lock:
+        record = inventory.setdefault(agent_id, {"id": agent_id, "facts": {}, "updated": None})
+        for key in fact_index_keys(record["facts"]):
+            inventory_index[key].discard(agent_id)
+            if not inventory_index[key]:
+                del inventory_index[key]
+        
+        record["facts"] = facts
+        record["updated"] = time.time()
+        for key in fact_index_keys(facts):
+            inventory_index[key].add(agent_id)
+
+def select_agents(filters, connected_only=False):
+    """Return the ids of the agents matching every (fact, value) filter."""
+    with agents_lock:
+        selected = None
+        for key, value in filters:
+            matches = inventory_index.get((key, str(value).lower()), set())
+            selected = set(matches) if selected is None else selected & matches
+            if not selected:
+                return []
+        if selected is None:
+            selected = set(inventory) | set(agents)
+        if connected_only:
+            selected &= set(agents)
+        return sorted(selected)
+
+def register_agent(agent_id, conn, addr):
+    """Record a new connection for an agent, replacing any previous one."""
+    global current_agent_id
+    
+    with agents_lock:
+        previous = agents.get(agent_id)
+        if previous:
+            try:
+                previous["conn"].close()
+            except:
+                pass
+        
+        agent = {
+            "id": agent_id,
+            "conn": conn,
+            "addr": f"{addr[0]}:{addr[1]}",
+            "connected": time.time(),
+            "outbox": queue.Queue()  # control messages for the agent
+        }
+        agents[agent_id] = agent
+        current_agent_id = agent_id
+    
+    with jobs_lock:
+        agent_queues.setdefault(agent_id, new_agent_queues())
+    return agent
+
+def unregister_agent(agent_id, conn):
+    """Forget an agent's connection, unless it has already been replaced."""
+    global current_agent_id
+    
+    with agents_lock:
+        agent = agents.get(agent_id)
+        if not agent or agent["conn"] is not conn:
+            return
+        del agents[agent_id]
+        if current_agent_id == agent_id:
+            remaining = sorted(agents.values(), key=lambda agent: agent["connected"])
+            current_agent_id = remaining[-1]["id"] if remaining else None
+    
+    # Results of jobs running on the lost connection will never arrive
+    now = time.time()
+    with jobs_lock:
+        queues = agent_queues.get(agent_id)
+        if queues:
+            for job_id in queues["running"]:
+                job = jobs.get(job_id)
+                if job:
+                    job["status"] = "lost"
+                    job["finished"] = now
+            queues["running"].clear()
+            job_events.notify_all()
+
+def resume_session(agent_id, session):
+    """Pick up the jobs an agent reports as still running after a reconnect.
+    
+    Jobs given up as lost when the connection, or the server, went away are
+    marked running again so that their results are accepted and they count
+    against the agent's in-flight limit. Jobs the server believes running
+    that the agent does not report will never finish and are lost.
+    """
+    reported = set(session.get("running") or [])
+    now = time.time()
+    with jobs_lock:
+        queues = agent_queues.setdefault(agent_id, new_agent_queues())
+        for job in jobs.values():
+            if job["agent"] != agent_id:
+                continue
+            if job["id"] in reported and job["status"] == "lost":
+                job["status"] = "running"
+                job["finished"] = None
+                job["uncredited"] = 0
+                queues["running"].add(job["id"])
+                print(f"[Server] Resumed job {job['id']} on agent {agent_id}")
+            elif job["id"] not in reported and job["status"] in ("running", "cancelling"):
+                job["status"] = "lost"
+                job["finished"] = now
+                queues["running"].discard(job["id"])
+        job_events.notify_all()
+
+def in_flight_count():
+    """Count the jobs dispatched to agents that have not reported back yet."""
+    with jobs_lock:
+        return sum(1 for job in jobs.values() if job["status"] in ("running", "cancelling"))
+
+def drain(timeout=DRAIN_TIMEOUT):
+    """Stop dispatching jobs and wait up to ``timeout`` seconds for running ones.
+    
+    An earlier deadline set by a drain already under way, such as one
+    started by ``POST /drain``, is kept. Returns the number of jobs still
+    running when the wait ended.
+    """
+    global draining, drain_deadline
+    
+    draining = True
+    deadline = time.time() + timeout
+    if drain_deadline is None or deadline < drain_deadline:
+        drain_deadline = deadline
+    remaining = in_flight_count()
+    while remaining and time.time() < drain_deadline:
+        time.sleep(0.5)
+        remaining = in_flight_count()
+    return remaining
+
+def save_snapshot():
+    """Write the jobs, watches, schedules, fan-outs, inventory, usage and pending output to disk.
+    
+    The file is written under a temporary name and renamed into place, so a
+    crash while saving never leaves a half-written snapshot behind.
+    """
+    with agents_lock:
+        with jobs_lock:
+            state = {
+                "saved": time.time(),
+                "jobs": list(jobs.values()),
+                "watches": list(watches.values()),
+                "schedules": list(schedules.values()),
+                "inventory": inventory,
+                "usage": {"agents": agent_usage, "commands": list(command_usage.items())},
+                "fanouts": [dict(fanout, pending=list(fanout["pending"]),
+                                 timed_out=list(fanout["timed_out"]))
+                            for fanout in fanouts.values()]
+            }
+            with output_queue.mutex:
+                state["output"] = [text for agent_id, text in output_queue.queue]
+            data = json.dumps(state, ensure_ascii=False)
+    
+    temp_path = SNAPSHOT_PATH + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(temp_path, SNAPSHOT_PATH)
+    print(f"[Server] Saved state of {len(state['jobs'])} jobs to {SNAPSHOT_PATH}")
+
+def load_snapshot():
+    """Restore the state saved by the previous run, if there is one.
+    
+    Queued jobs are queued again in their original order. Jobs that were
+    running are marked lost until their agent reconnects and resumes them.
+    Watch and schedule timers are set again; runs missed while the server
+    was down are handled by each schedule's missed-run policy.
+    """
+    try:
+        with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"[Server] Ignoring unreadable snapshot {SNAPSHOT_PATH}: {e}")
+        return
+    
+    now = time.time()
+    with agents_lock:
+        for agent_id, record in state.get("inventory", {}).items():
+            inventory[agent_id] = record
+            for key in fact_index_keys(record["facts"]):
+                inventory_index[key].add(agent_id)
+    
+    with jobs_lock:
+        for job in sorted(state.get("jobs", []), key=lambda job: job["created"]):
+            jobs[job["id"]] = job
+            if job["status"] == "queued":
+                queues = agent_queues.setdefault(job["agent"], new_agent_queues())
+                queues[job["priority"]].setdefault(job["submitter"],
+                                                   collections.deque()).append(job)
+            elif job["status"] in ("running", "cancelling"):
+                job["status"] = "lost"
+                job["finished"] = now
+                job["uncredited"] = 0
+        for watch in state.get("watches", []):
+            watches[watch["id"]] = watch
+        for schedule in state.get("schedules", []):
+            schedules[schedule["id"]] = schedule
+        usage = state.get("usage", {})
+        agent_usage.update(usage.get("agents", {}))
+        command_usage.update(usage.get("commands", []))
+        for fanout in state.get("fanouts", []):
+            fanout["pending"] = set(fanout["pending"])
+            fanout["timed_out"] = set(fanout["timed_out"])
+            fanout.setdefault("announced", False)
+            fanouts[fanout["id"]] = fanout
+    
+    for watch in state.get("watches", []):
+        add_timer(watch["next_run"], "watch", watch["id"])
+    for schedule in state.get("schedules", []):
+        add_timer(schedule["next_run"] + random.uniform(0, schedule["jitter"]),
+                  "schedule", schedule["id"])
+    for fanout in state.get("fanouts", []):
+        add_timer(fanout["deadline"], "fanout", fanout["id"])
+    for text in state.get("output", []):
+        output_queue.put(text)
+    
+    os.remove(SNAPSHOT_PATH)
+    print(f"[Server] Restored state of {len(state.get('jobs', []))} jobs from {SNAPSHOT_PATH}")
 
 def socket_server():
     """Run the socket server that accepts client connections."""
-    global server_socket, client_socket, client_connected, client_info, server_running
+    global server_socket, server_running
     
     try:
         # Create server socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind(('0.0.0.0', 7878))
-        server_socket.listen(1)
+        server_socket.listen(128)
         server_socket.settimeout(1)  # 1 second timeout for accept()
         
         print("[Server] Socket server started on 0.0.0.0:7878")
@@ -45,19 +1319,6 @@ def socket_server():
                 # Accept connection (with timeout)
                 conn, addr = server_socket.accept()
                 
-                with client_lock:
-                    # Close any existing connection
-                    if client_socket:
-                        try:
-                            client_socket.close()
-                        except:
-                            pass
-                    
-                    # Set new connection
-                    client_socket = conn
-                    client_connected = True
-                    client_info = f"{addr[0]}:{addr[1]}"
-                
                 print(f"[Server] Client connected from {addr}")
                 output_queue.put(f"Client connected from {addr}\n")
                 
@@ -71,6 +1332,8 @@ def socket_server():
             except Exception as e:
                 print(f"[Server] Error accepting connection: {e}")
                 time.sleep(1)
+            finally:
+                expire_jobs()
     
     except Exception as e:
         print(f"[Server] Socket server error: {e}")
@@ -83,71 +1346,191 @@ def socket_server():
                 pass
         print("[Server] Socket server stopped")
 
+def receive_hello(conn, addr):
+    """Wait for the client's hello message.
+    
+    Returns the agent id, the facts and session it reported and the bytes
+    received after the hello. Clients that do not send a hello are
+    identified by their address, and whatever they sent is handed back to
+    be processed as usual.
+    """
+    fallback_id = f"{addr[0]}:{addr[1]}"
+    buffer = b""
+    deadline = time.time() + HELLO_TIMEOUT
+    while b"\n" not in buffer and time.time() < deadline:
+        try:
+            data = conn.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            raise ConnectionError("Connection closed before hello")
+        buffer += data
+    
+    if b"\n" not in buffer:
+        return fallback_id, None, None, buffer
+    
+    line, rest = buffer.split(b"\n", 1)
+    try:
+        hello = json.loads(line.decode('utf-8', errors='replace'))
+    except json.JSONDecodeError:
+        return fallback_id, None, None, buffer
+    if hello.get("type") != "hello":
+        return fallback_id, None, None, buffer
+    
+    output_queue.put(f"Info: {hello.get('data', '')}\n")
+    return hello.get("agent_id") or fallback_id, hello.get("facts"), hello.get("session"), rest
+
+def encode_json(obj):
+    """Encode one newline-terminated JSON message."""
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode('utf-8')
+
+def send_frames(conn, frames):
+    """Write encoded messages to a socket with as few calls as possible.
+    
+    Returns the number of send calls made. Partial writes are resumed from
+    where they stopped.
+    """
+    if not hasattr(conn, "sendmsg"):
+        # No vectored I/O on this platform
+        conn.sendall(b"".join(frames))
+        return 1
+    
+    views = [memoryview(frame) for frame in frames]
+    calls = 0
+    while views:
+        sent = conn.sendmsg(views[:MAX_IOV])
+        calls += 1
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+    return calls
+
+def flush_frames(conn, frames):
+    """Send and clear the messages queued for a connection."""
+    if not frames:
+        return
+    calls = send_frames(conn, frames)
+    with link_stats_lock:
+        link_stats["messages_sent"] += len(frames)
+        link_stats["send_calls"] += calls
+        link_stats["bytes_sent"] += sum(len(frame) for frame in frames)
+    frames.clear()
+
+def send_json(conn, obj):
+    """Send one newline-terminated JSON message on a connection right away."""
+    message = json.dumps(obj, ensure_ascii=False) + "\n"
+    flush_frames(conn, [message.encode('utf-8')])
+    return message
+
 def handle_client(conn, addr):
     """Handle communication with a connected client."""
-    global client_connected, client_info
+    agent_id = None
     
     try:
         # Send initial message with proper formatting
-        welcome_obj = {"type": "info", "data": "Connected to server"}
-        welcome_msg = json.dumps(welcome_obj, ensure_ascii=False) + "\n"
-        conn.sendall(welcome_msg.encode('utf-8'))
+        welcome_msg = send_json(conn, {"type": "info", "data": "Connected to server"})
         print(f"[Server] Sent welcome message: {welcome_msg.strip()}")
         
-        # Set socket timeout for recv
+        # Set socket timeout for recv; batching is done here rather than by Nagle
         conn.settimeout(0.5)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        # Bytes received but not yet terminated by a newline
+        agent_id, facts, session, buffer = receive_hello(conn, addr)
+        agent = register_agent(agent_id, conn, addr)
+        if facts:
+            update_facts(agent_id, facts)
+        if session is not None:
+            resume_session(agent_id, session)
+        print(f"[Server] Agent {agent_id} registered from {addr}")
+        paused = False
+        
+        # Messages for the agent queued during one pass of the loop; they
+        # are written together before waiting for the agent's output
+        frames = []
         
         while True:
-            # Check for commands to send
-            if not command_queue.empty():
-                cmd = command_queue.get()
-                try:
-                    # Format command as JSON with proper formatting
-                    cmd_obj = {"type": "command", "data": cmd}
-                    cmd_json = json.dumps(cmd_obj, ensure_ascii=False) + "\n"
-                    conn.sendall(cmd_json.encode('utf-8'))
-                    print(f"[Server] Sent command: {cmd}")
-                    print(f"[Server] JSON sent: {cmd_json.strip()}")
-                except Exception as e:
-                    print(f"[Server] Error sending command: {e}")
-                    output_queue.put(f"Error sending command: {e}\n")
+            # Queue pending control messages, such as cancellations
+            while not agent["outbox"].empty():
+                frames.append(encode_json(agent["outbox"].get()))
+            
+            # Queue every command the scheduler lets this agent run now
+            while True:
+                job = next_job(agent_id)
+                if not job:
                     break
+                cmd = job["command"]
+                frames.append(encode_json({
+                    "type": "command",
+                    "data": cmd,
+                    "job_id": job["id"],
+                    "max_output": job["max_output"],
+                    "filter": job["filter"],
+                    "watch": watch_command_info(job),
+                    "credit": JOB_CREDIT_WINDOW
+                }))
+                print(f"[Server] Sending command: {cmd}")
+            
+            # Apply backpressure while the output consumer is behind on this
+            # agent; it runs out of credit and stops reading its pipes
+            was_paused, paused = paused, feed_paused(agent_id, paused)
+            if paused != was_paused:
+                print(f"[Server] {'Pausing' if paused else 'Resuming'} reads from agent {agent_id}")
+            if not paused:
+                for job_id, credit in take_credits(agent_id):
+                    frames.append(encode_json({"type": "credit", "data": credit, "job_id": job_id}))
+            
+            try:
+                flush_frames(conn, frames)
+            except Exception as e:
+                print(f"[Server] Error sending to agent {agent_id}: {e}")
+                output_queue.put(f"Error sending command: {e}\n")
+                break
             
-            # Check for client output
+            if paused:
+                time.sleep(0.1)
+                continue
+            
+            # Check for client output. The recv timeout is the idle wait, so
+            # output that keeps arriving is read without further delay.
             try:
-                data = conn.recv(4096)
+                data = conn.recv(RECV_BYTES)
                 if not data:  # Connection closed
                     break
+                buffer += data
+                with link_stats_lock:
+                    link_stats["recv_calls"] += 1
+                    link_stats["bytes_received"] += len(data)
+            except socket.timeout:
+                # This is expected due to the timeout we set
+                if not buffer:
+                    continue
+            except Exception as e:
+                print(f"[Server] Error receiving data: {e}")
+                break
+            
+            # Messages are newline-delimited and may span several reads;
+            # the last piece is the start of a message still to come
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            with link_stats_lock:
+                link_stats["messages_received"] += len(lines)
+            for line in lines:
+                msg = line.decode('utf-8', errors='replace')
+                if not msg.strip():
+                    continue
                 
                 # Try to parse as JSON
                 try:
-                    messages = data.decode('utf-8', errors='replace').split('\n')
-                    for msg in messages:
-                        if not msg.strip():
-                            continue
-                        
-                        response = json.loads(msg)
-                        if response.get("type") == "output":
-                            output_queue.put(response.get("data", "") + "\n")
-                        elif response.get("type") == "error":
-                            output_queue.put(f"Error: {response.get('data', '')}\n")
-                        elif response.get("type") == "info":
-                            output_queue.put(f"Info: {response.get('data', '')}\n")
+                    handle_client_message(agent_id, json.loads(msg))
                 except json.JSONDecodeError:
                     # If not valid JSON, treat as raw output
-                    output_queue.put(data.decode('utf-8', errors='replace'))
+                    output_queue.put((agent_id, msg + "\n"))
                 except Exception as e:
                     print(f"[Server] Error processing client data: {e}")
-            
-            except socket.timeout:
-                # This is expected due to the timeout we set
-                continue
-            except Exception as e:
-                print(f"[Server] Error receiving data: {e}")
-                break
-            
-            # Small delay to prevent CPU hogging
-            time.sleep(0.01)
     
     except Exception as e:
         print(f"[Server] Client handler error: {e}")
@@ -158,49 +1541,570 @@ def handle_client(conn, addr):
         except:
             pass
         
-        with client_lock:
-            if client_socket == conn:
-                client_socket = None
-                client_connected = False
-                client_info = None
+        if agent_id:
+            unregister_agent(agent_id, conn)
         
         print(f"[Server] Client disconnected from {addr}")
         output_queue.put(f"Client disconnected from {addr}\n")
 
+def handle_client_message(agent_id, response):
+    """Handle a single JSON message received from an agent."""
+    msg_type = response.get("type")
+    job_id = response.get("job_id")
+    
+    if msg_type == "output_chunk":
+        data = base64.b64decode(response.get("data", ""))
+        append_job_output(job_id, response.get("offset", 0), data)
+    elif msg_type == "output":
+        if response.get("watch_id"):
+            finish_watch_job(job_id, response["watch_id"], response)
+            return
+        job = finish_job(job_id, "done", response) if job_id else None
+        # Fan-outs post one summary line instead of a copy per agent
+        if not (job and job["fanout"]):
+            output_queue.put((agent_id, response.get("data", "") + "\n"))
+    elif msg_type == "error":
+        job = finish_job(job_id, "error", response) if job_id else None
+        if not (job and job["fanout"]):
+            output_queue.put((agent_id, f"Error: {response.get('data', '')}\n"))
+    elif msg_type == "info":
+        output_queue.put((agent_id, f"Info: {response.get('data', '')}\n"))
+    elif msg_type == "facts":
+        update_facts(agent_id, response.get("data"))
+
+def watch_command_info(job):
+    """Return the watch details sent to the agent with a watch job, or None."""
+    if not job["watch"]:
+        return None
+    with jobs_lock:
+        watch = watches.get(job["watch"])
+        base_seq = watch["seq"] if watch else None
+    return {"id": job["watch"], "base_seq": base_seq}
+
+def resolve_agent(agent_id=None):
+    """Return a connected agent by id, or the current agent if no id is given."""
+    with agents_lock:
+        return agents.get(agent_id or current_agent_id)
+
 # API Routes
 @app.route('/status', methods=['GET'])
 def get_status():
     """Get the current server status."""
-    with client_lock:
-        return jsonify({
-            "connected": client_connected,
-            "client": client_info,
-            "pending_commands": command_queue.qsize(),
-            "pending_outputs": output_queue.qsize()
-        })
+    agent = resolve_agent()
+    with agents_lock:
+        agent_count = len(agents)
+    with link_stats_lock:
+        link = dict(link_stats)
+    
+    return jsonify({
+        "connected": agent is not None,
+        "client": agent["addr"] if agent else None,
+        "agent": agent["id"] if agent else None,
+        "agents": agent_count,
+        "draining": draining,
+        "pending_commands": queued_job_count(),
+        "pending_outputs": output_queue.qsize(),
+        "pending_output_bytes": output_queue.chars,
+        "dropped_outputs": output_queue.dropped,
+        "link": link
+    })
+
+def agent_summary(agent_id, pending):
+    """Return the public view of an agent from the inventory. Caller holds agents_lock."""
+    record = inventory.get(agent_id, {})
+    agent = agents.get(agent_id)
+    return {
+        "id": agent_id,
+        "connected": agent is not None,
+        "addr": agent["addr"] if agent else None,
+        "connected_at": agent["connected"] if agent else None,
+        "facts": record.get("facts", {}),
+        "facts_updated": record.get("updated"),
+        "pending_commands": pending.get(agent_id, 0)
+    }
+
+@app.route('/agents', methods=['GET'])
+def list_agents():
+    """List agents from the inventory, filtered by facts.
+    
+    Every query parameter is a fact to match, e.g. ``?os=Linux&label=rack3``;
+    ``label`` may be repeated. ``connected=true`` restricts the list to
+    connected agents.
+    """
+    connected_only = request.args.get('connected', '').lower() in ('1', 'true', 'yes')
+    filters = [(key, value) for key, values in request.args.lists() if key != 'connected'
+               for value in values]
+    
+    selected = select_agents(filters, connected_only)
+    pending = queued_job_counts()
+    with agents_lock:
+        agent_list = [agent_summary(agent_id, pending) for agent_id in selected]
+    
+    return jsonify({
+        "status": "success",
+        "agents": agent_list
+    })
+
+@app.route('/agents/<agent_id>', methods=['GET'])
+def get_agent(agent_id):
+    """Get an agent's connection state and facts."""
+    pending = queued_job_counts()
+    with agents_lock:
+        if agent_id not in inventory and agent_id not in agents:
+            return jsonify({"error": "Unknown agent"}), 404
+        summary = agent_summary(agent_id, pending)
+    
+    return jsonify({
+        "status": "success",
+        "agent": summary
+    })
 
 @app.route('/command', methods=['POST'])
 def send_command():
-    """Send a command to the connected client."""
-    with client_lock:
-        if not client_connected:
+    """Queue a command for an agent, by default the most recently connected one."""
+    data = request.get_json()
+    if not data or 'command' not in data:
+        return jsonify({"error": "Missing 'command' field"}), 400
+    if draining:
+        return jsonify({"error": "Server is draining"}), 503
+    
+    agent = resolve_agent(data.get('agent'))
+    if not agent:
+        return jsonify({"error": "No client connected"}), 503
+    
+    priority = data.get('priority', 'interactive')
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"'priority' must be one of {', '.join(PRIORITIES)}"}), 400
+    deadline = data.get('deadline')
+    if deadline is not None and (not isinstance(deadline, (int, float)) or deadline <= 0):
+        return jsonify({"error": "'deadline' must be a positive number of seconds"}), 400
+    max_output = data.get('max_output')
+    if max_output is not None and (not isinstance(max_output, int) or max_output <= 0):
+        return jsonify({"error": "'max_output' must be a positive number of bytes"}), 400
+    
+    try:
+        output_filter = parse_output_filter(data.get('filter'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    command = data['command']
+    job = create_job(command, agent["id"],
+                     max_output=max_output,
+                     priority=priority,
+                     submitter=data.get('submitter') or request.remote_addr,
+                     deadline=deadline,
+                     output_filter=output_filter)
+    
+    return jsonify({
+        "status": "success",
+        "message": f"Command '{command}' sent to the shell",
+        "job_id": job["id"]
+    })
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """List known jobs, most recent first."""
+    with jobs_lock:
+        job_list = sorted((job_summary(job) for job in jobs.values()),
+                          key=lambda job: job["created"], reverse=True)
+    
+    return jsonify({
+        "status": "success",
+        "jobs": job_list
+    })
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the status and output summary of a job.
+    
+    With ``wait`` the request waits up to that many seconds for the job to
+    finish before answering.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if not job:
+            return jsonify({"error": "Unknown job"}), 404
+        wait_for_job(job, wait, lambda job: job["finished"] is not None)
+        summary = job_summary(job)
+        summary["output"] = job["result"]
+        if job.get("output_group") and job["fanout"] in fanouts:
+            # Fan-out jobs share the output kept by their group
+            summary["output"] = fanouts[job["fanout"]]["groups"][job["output_group"]]["output"]
+    
+    return jsonify({
+        "status": "success",
+        "job": summary
+    })
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    """Cancel a queued or running job."""
+    job = cancel_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] not in ("cancelled", "cancelling"):
+        return jsonify({"error": f"Job already {job['status']}"}), 409
+    
+    return jsonify({
+        "status": "success",
+        "message": f"Job {job_id} {job['status']}"
+    })
+
+@app.route('/jobs/<job_id>/output', methods=['GET'])
+def get_job_output(job_id):
+    """Read a byte range of a job's full spooled output.
+    
+    With ``wait``, a request for output that has not arrived yet waits up
+    to that many seconds for it, or for the job to finish.
+    """
+    offset = request.args.get('offset', 0, type=int)
+    length = request.args.get('length', DEFAULT_PAGE_SIZE, type=int)
+    wait = request.args.get('wait', 0, type=float)
+    if offset < 0 or length <= 0:
+        return jsonify({"error": "Invalid 'offset' or 'length'"}), 400
+    
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if not job:
+            return jsonify({"error": "Unknown job"}), 404
+        wait_for_job(job, wait, lambda job: job["spooled_bytes"] > offset
+                     or job["finished"] is not None)
+        spooled = job["spooled_bytes"]
+        status = job["status"]
+    
+    length = min(length, MAX_PAGE_SIZE, max(spooled - offset, 0))
+    
+    data = b""
+    if length:
+        with open(spool_path(job_id), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+    
+    response = Response(data, mimetype='application/octet-stream')
+    response.headers['X-Output-Offset'] = str(offset)
+    response.headers['X-Output-Size'] = str(spooled)
+    response.headers['X-Next-Offset'] = str(offset + len(data))
+    response.headers['X-Job-Status'] = status
+    return response
+
+@app.route('/stats/usage', methods=['GET'])
+def get_usage_stats():
+    """Get the resource usage of finished jobs, totalled per agent and per command.
+    
+    Commands are sorted by ``sort`` (total CPU time by default), most
+    expensive first, and limited to ``limit`` entries.
+    """
+    sort_key = request.args.get('sort', 'cpu_time')
+    if sort_key not in USAGE_SORT_KEYS:
+        return jsonify({"error": f"'sort' must be one of {', '.join(USAGE_SORT_KEYS)}"}), 400
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+    
+    with jobs_lock:
+        agent_stats = {agent_id: usage_summary(totals) for agent_id, totals in agent_usage.items()}
+        command_stats = [dict(usage_summary(totals), command=command)
+                         for command, totals in command_usage.items()]
+    command_stats.sort(key=lambda stats: stats[sort_key], reverse=True)
+    
+    return jsonify({
+        "status": "success",
+        "agents": agent_stats,
+        "commands": command_stats[:limit]
+    })
+
+@app.route('/watches', methods=['POST'])
+def add_watch():
+    """Re-run a command on an agent at a fixed interval."""
+    data = request.get_json()
+    if not data or 'command' not in data:
+        return jsonify({"error": "Missing 'command' field"}), 400
+    if draining:
+        return jsonify({"error": "Server is draining"}), 503
+    
+    agent = resolve_agent(data.get('agent'))
+    if not agent:
+        return jsonify({"error": "No client connected"}), 503
+    
+    interval = data.get('interval', 5)
+    if not isinstance(interval, (int, float)) or interval < MIN_WATCH_INTERVAL:
+        return jsonify({"error": f"'interval' must be at least {MIN_WATCH_INTERVAL} second(s)"}), 400
+    
+    try:
+        output_filter = parse_output_filter(data.get('filter'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    watch = create_watch(data['command'], agent["id"], interval, output_filter)
+    return jsonify({
+        "status": "success",
+        "message": f"Watching '{watch['command']}' every {interval}s",
+        "watch_id": watch["id"]
+    })
+
+@app.route('/watches', methods=['GET'])
+def list_watches():
+    """List the active watches."""
+    with jobs_lock:
+        watch_list = [watch_summary(watch) for watch in watches.values()]
+    
+    return jsonify({
+        "status": "success",
+        "watches": watch_list
+    })
+
+@app.route('/watches/<watch_id>', methods=['GET'])
+def get_watch(watch_id):
+    """Get a watch and the full output of its latest run."""
+    with jobs_lock:
+        watch = watches.get(watch_id)
+        if not watch:
+            return jsonify({"error": "Unknown watch"}), 404
+        summary = watch_summary(watch)
+        summary["output"] = "".join(watch["lines"])
+    
+    return jsonify({
+        "status": "success",
+        "watch": summary
+    })
+
+@app.route('/watches/<watch_id>', methods=['DELETE'])
+def delete_watch(watch_id):
+    """Stop a watch."""
+    with jobs_lock:
+        watch = watches.pop(watch_id, None)
+    if not watch:
+        return jsonify({"error": "Unknown watch"}), 404
+    
+    if watch["job"]:
+        cancel_job(watch["job"])
+    agent = resolve_agent(watch["agent"])
+    if agent:
+        agent["outbox"].put({"type": "unwatch", "data": "", "watch_id": watch_id})
+    
+    return jsonify({
+        "status": "success",
+        "message": f"Watch {watch_id} stopped"
+    })
+
+@app.route('/schedules', methods=['POST'])
+def add_schedule():
+    """Run a command on a set of agents at an interval or on a cron schedule."""
+    data = request.get_json()
+    if not data or 'command' not in data:
+        return jsonify({"error": "Missing 'command' field"}), 400
+    if draining:
+        return jsonify({"error": "Server is draining"}), 503
+    
+    interval, cron = data.get('interval'), data.get('cron')
+    if (interval is None) == (cron is None):
+        return jsonify({"error": "Give exactly one of 'interval' and 'cron'"}), 400
+    if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+        return jsonify({"error": "'interval' must be a positive number of seconds"}), 400
+    if cron is not None:
+        if not isinstance(cron, str):
+            return jsonify({"error": "'cron' must be a cron expression string"}), 400
+        try:
+            next_cron_time(parse_cron(cron), time.time())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    jitter = data.get('jitter', 0)
+    if not isinstance(jitter, (int, float)) or jitter < 0:
+        return jsonify({"error": "'jitter' must be a non-negative number of seconds"}), 400
+    max_output = data.get('max_output')
+    if max_output is not None and (not isinstance(max_output, int) or max_output <= 0):
+        return jsonify({"error": "'max_output' must be a positive number of bytes"}), 400
+    
+    missed = data.get('missed', 'run_once')
+    overlap = data.get('overlap', 'skip')
+    priority = data.get('priority', 'batch')
+    for name, value, allowed in (("missed", missed, MISSED_RUN_POLICIES),
+                                 ("overlap", overlap, OVERLAP_POLICIES),
+                                 ("priority", priority, PRIORITIES)):
+        if value not in allowed:
+            return jsonify({"error": f"'{name}' must be one of {', '.join(allowed)}"}), 400
+    
+    # Targets: explicit agents, an inventory selector, or the current agent
+    if data.get('selector'):
+        try:
+            targets = {"selector": parse_selector(data['selector'])}
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    elif data.get('agents') or data.get('agent'):
+        try:
+            targets = {"agents": parse_agent_ids(data.get('agents') or [data['agent']])}
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        agent = resolve_agent()
+        if not agent:
             return jsonify({"error": "No client connected"}), 503
+        targets = {"agents": [agent["id"]]}
+    
+    try:
+        output_filter = parse_output_filter(data.get('filter'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    schedule = create_schedule(data['command'], targets, interval=interval, cron=cron,
+                               jitter=jitter, missed=missed, overlap=overlap,
+                               priority=priority, output_filter=output_filter,
+                               max_output=max_output)
+    return jsonify({
+        "status": "success",
+        "message": f"Scheduled '{schedule['command']}'",
+        "schedule_id": schedule["id"]
+    })
+
+@app.route('/schedules', methods=['GET'])
+def list_schedules():
+    """List the recurring schedules."""
+    with jobs_lock:
+        schedule_list = [dict(schedule, jobs=dict(schedule["jobs"]))
+                         for schedule in schedules.values()]
+    
+    return jsonify({
+        "status": "success",
+        "schedules": schedule_list
+    })
+
+@app.route('/schedules/<schedule_id>', methods=['GET'])
+def get_schedule(schedule_id):
+    """Get a schedule and the status of its latest job on each agent."""
+    with jobs_lock:
+        schedule = schedules.get(schedule_id)
+        if not schedule:
+            return jsonify({"error": "Unknown schedule"}), 404
+        summary = dict(schedule)
+        summary["jobs"] = {agent_id: job_summary(jobs[job_id])
+                           for agent_id, job_id in schedule["jobs"].items() if job_id in jobs}
     
+    return jsonify({
+        "status": "success",
+        "schedule": summary
+    })
+
+@app.route('/schedules/<schedule_id>', methods=['DELETE'])
+def delete_schedule(schedule_id):
+    """Delete a schedule. Jobs it already queued are left alone."""
+    with jobs_lock:
+        schedule = schedules.pop(schedule_id, None)
+    if not schedule:
+        return jsonify({"error": "Unknown schedule"}), 404
+    
+    return jsonify({
+        "status": "success",
+        "message": f"Schedule {schedule_id} deleted"
+    })
+
+@app.route('/fanouts', methods=['POST'])
+def add_fanout():
+    """Run a command on many agents and group their results by identical output."""
     data = request.get_json()
     if not data or 'command' not in data:
         return jsonify({"error": "Missing 'command' field"}), 400
+    if draining:
+        return jsonify({"error": "Server is draining"}), 503
     
-    command = data['command']
-    command_queue.put(command)
+    priority = data.get('priority', 'interactive')
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"'priority' must be one of {', '.join(PRIORITIES)}"}), 400
+    timeout = data.get('timeout', DEFAULT_FANOUT_TIMEOUT)
+    if not isinstance(timeout, (int, float)) or timeout <= 0:
+        return jsonify({"error": "'timeout' must be a positive number of seconds"}), 400
+    max_output = data.get('max_output')
+    if max_output is not None and (not isinstance(max_output, int) or max_output <= 0):
+        return jsonify({"error": "'max_output' must be a positive number of bytes"}), 400
+    try:
+        normalize = parse_normalize(data.get('normalize'))
+        output_filter = parse_output_filter(data.get('filter'))
+        selector = parse_selector(data['selector']) if data.get('selector') else []
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Targets: explicit agents, or the connected agents matching the selector
+    if data.get('agents'):
+        try:
+            agent_ids = parse_agent_ids(data['agents'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        agent_ids = select_agents(selector, connected_only=True)
+    if not agent_ids:
+        return jsonify({"error": "No agents match"}), 404
+    
+    fanout = create_fanout(data['command'], agent_ids,
+                           normalize=normalize,
+                           timeout=timeout,
+                           priority=priority,
+                           submitter=data.get('submitter') or request.remote_addr,
+                           output_filter=output_filter,
+                           max_output=max_output)
+    return jsonify({
+        "status": "success",
+        "message": f"Command '{fanout['command']}' sent to {len(agent_ids)} agents",
+        "fanout_id": fanout["id"]
+    })
+
+@app.route('/fanouts', methods=['GET'])
+def list_fanouts():
+    """List fan-outs with their one-line summaries, most recent first."""
+    with jobs_lock:
+        fanout_list = [fanout_summary(fanout, detail=False)
+                       for fanout in reversed(list(fanouts.values()))]
+    
+    return jsonify({
+        "status": "success",
+        "fanouts": fanout_list
+    })
+
+@app.route('/fanouts/<fanout_id>', methods=['GET'])
+def get_fanout(fanout_id):
+    """Get a fan-out's output groups and the agents in each.
+    
+    With ``wait`` the request waits up to that many seconds for every
+    result to be in before answering.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    with jobs_lock:
+        fanout = fanouts.get(fanout_id)
+        if not fanout:
+            return jsonify({"error": "Unknown fan-out"}), 404
+        wait_for_job(fanout, wait, lambda fanout: fanout_summary(fanout, detail=False)["complete"])
+        summary = fanout_summary(fanout)
+    
+    return jsonify({
+        "status": "success",
+        "fanout": summary
+    })
+
+@app.route('/fanouts/<fanout_id>', methods=['DELETE'])
+def delete_fanout(fanout_id):
+    """Forget a fan-out, cancelling the jobs it is still waiting for."""
+    with jobs_lock:
+        fanout = fanouts.pop(fanout_id, None)
+        if fanout:
+            for job_id in fanout["pending"]:
+                fanout_digests.pop(job_id, None)
+    if not fanout:
+        return jsonify({"error": "Unknown fan-out"}), 404
     
+    for job_id in fanout["pending"]:
+        cancel_job(job_id)
     return jsonify({
         "status": "success",
-        "message": f"Command '{command}' sent to the shell"
+        "message": f"Fan-out {fanout_id} deleted"
     })
 
 @app.route('/output', methods=['GET'])
 def get_output():
     """Get any pending output from the client."""
+    global last_output_poll
+    
+    last_output_poll = time.time()
     outputs = []
     
     # Get all available outputs (non-blocking)
@@ -214,10 +2118,14 @@ def get_output():
 
 @app.route('/clear', methods=['POST'])
 def clear_queues():
-    """Clear the command and output queues."""
-    # Clear both queues
-    while not command_queue.empty():
-        command_queue.get()
+    """Cancel all queued jobs and clear the output queue."""
+    now = time.time()
+    with jobs_lock:
+        for job in jobs.values():
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+                job["finished"] = now
+        job_events.notify_all()
     
     while not output_queue.empty():
         output_queue.get()
@@ -229,558 +2137,177 @@ def clear_queues():
 
 @app.route('/disconnect', methods=['POST'])
 def disconnect_client():
-    """Disconnect the current client."""
-    global client_socket
+    """Disconnect an agent, by default the current one."""
+    data = request.get_json(silent=True) or {}
+    agent = resolve_agent(data.get('agent'))
+    if not agent:
+        return jsonify({"error": "No client connected"}), 503
     
-    with client_lock:
-        if client_socket:
-            try:
-                client_socket.close()
-                return jsonify({"status": "success", "message": "Client disconnected"})
-            except Exception as e:
-                return jsonify({"error": f"Error disconnecting client: {e}"}), 500
-        else:
-            return jsonify({"error": "No client connected"}), 503
+    try:
+        agent["conn"].close()
+        return jsonify({"status": "success", "message": "Client disconnected"})
+    except Exception as e:
+        return jsonify({"error": f"Error disconnecting client: {e}"}), 500
 
-@app.route('/')
-def index():
-    """Serve the web interface."""
-    html_content = """<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Simple Shell Control Panel</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            max-width: 800px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #f5f5f5;
-        }
-        .container {
-            background-color: white;
-            border-radius: 5px;
-            padding: 20px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .status {
-            display: flex;
-            justify-content: space-between;
-            margin-bottom: 20px;
-            padding: 10px;
-            background-color: #f0f0f0;
-            border-radius: 5px;
-        }
-        .status-indicator {
-            display: inline-block;
-            width: 12px;
-            height: 12px;
-            border-radius: 50%;
-            margin-right: 5px;
-        }
-        .connected { background-color: #4CAF50; }
-        .disconnected { background-color: #F44336; }
-        
-        .terminal {
-            background-color: #2b2b2b;
-            color: #f0f0f0;
-            padding: 15px;
-            border-radius: 5px;
-            height: 400px;
-            overflow-y: auto;
-            font-family: monospace;
-            margin-bottom: 20px;
-            white-space: pre-wrap;
-        }
-        .command-input {
-            display: flex;
-            margin-bottom: 20px;
-        }
-        input[type="text"] {
-            flex-grow: 1;
-            padding: 10px;
-            border: 1px solid #ddd;
-            border-radius: 5px 0 0 5px;
-            font-family: monospace;
-        }
-        button {
-            padding: 10px 15px;
-            background-color: #4CAF50;
-            color: white;
-            border: none;
-            cursor: pointer;
-            transition: background-color 0.3s;
-        }
-        button:hover {
-            background-color: #45a049;
-        }
-        .send-btn {
-            border-radius: 0 5px 5px 0;
-        }
-        .clear-btn {
-            border-radius: 5px;
-            margin-left: 10px;
-            background-color: #f44336;
-        }
-        .clear-btn:hover {
-            background-color: #d32f2f;
-        }
-        .action-btn {
-            border-radius: 5px;
-            margin-left: 5px;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Simple Shell Control Panel</h1>
-        
-        <div class="api-config" style="margin-bottom: 15px; padding: 10px; background-color: #f0f0f0; border-radius: 5px;">
-            <div style="margin-bottom: 5px; font-weight: bold;">API Connection Settings</div>
-            <form id="api-form" style="display: flex; align-items: center;">
-                <label for="api-url" style="margin-right: 10px;">API URL:</label>
-                <input type="text" id="api-url" style="flex-grow: 1; padding: 8px; border: 1px solid #ddd; border-radius: 5px; margin-right: 10px;" 
-                       placeholder="http://server-ip:8080">
-                <button type="submit" class="action-btn">Connect</button>
-            </form>
-            <div id="api-status" style="margin-top: 5px; font-size: 0.9em; color: #666;">
-                Current API: <span id="current-api-url"></span>
-            </div>
-            <div style="margin-top: 10px; font-size: 0.85em;">
-                <details>
-                    <summary style="cursor: pointer; color: #0066cc;">Troubleshooting</summary>
-                    <div style="margin-top: 5px; padding: 5px; background-color: #f9f9f9; border-radius: 3px;">
-                        <p>If you're having connection issues:</p>
-                        <ol style="margin-top: 5px; padding-left: 20px;">
-                            <li>Make sure the server is running on the correct IP and port</li>
-                            <li>Try using the full URL including protocol: <code>http://server-ip:8080</code></li>
-                            <li>Check for any network restrictions or firewalls</li>
-                            <li>Verify the server's CORS settings allow connections from this origin</li>
-                        </ol>
-                        <p style="margin-top: 5px;">Server is running on port 8080 and socket server on port 7878.</p>
-                    </div>
-                </details>
-            </div>
-        </div>
-        
-        <div class="status">
-            <div>
-                <span class="status-indicator disconnected" id="status-light"></span>
-                <span id="status-text">Disconnected</span>
-            </div>
-            <div>
-                <button id="refresh-status" class="action-btn">Refresh</button>
-                <button id="disconnect-client" class="action-btn" style="background-color: #f44336;">Disconnect</button>
-            </div>
-        </div>
-        
-        <div class="terminal" id="terminal"></div>
-        
-        <div class="command-input">
-            <input type="text" id="command" placeholder="Enter command..." autocomplete="off">
-            <button class="send-btn" id="send-command">Send</button>
-            <button class="clear-btn" id="clear-terminal">Clear</button>
-        </div>
-        
-        <div style="margin-top: 20px; text-align: right;">
-            <button id="toggle-debug" class="action-btn" style="background-color: #555; font-size: 0.8em;">Show Debug Console</button>
-        </div>
-        
-        <div id="debug-section" style="margin-top: 10px; display: none;">
-            <div style="font-weight: bold; margin-bottom: 5px;">Debug Console</div>
-            <div id="debug-console" style="background-color: #000; color: #0f0; font-family: monospace; padding: 10px; height: 150px; overflow-y: auto; border-radius: 5px; font-size: 0.9em;"></div>
-        </div>
-    </div>
-
-    <script>
-        // Get the API URL from localStorage, URL parameters, or default to window.location.origin
-        function getApiUrl() {
-            // Check if there's a URL parameter for the API
-            const urlParams = new URLSearchParams(window.location.search);
-            const apiParam = urlParams.get('api');
-            
-            if (apiParam) {
-                // Save to localStorage for future use
-                localStorage.setItem('apiUrl', apiParam);
-                return apiParam;
-            }
-            
-            // Check if we have a saved API URL in localStorage
-            const savedApiUrl = localStorage.getItem('apiUrl');
-            if (savedApiUrl) {
-                return savedApiUrl;
-            }
-            
-            // Otherwise use the current origin
-            return window.location.origin;
-        }
-        
-        const API_URL = getApiUrl();
-        console.log("Using API URL:", API_URL);
-        let isConnected = false;
-        let outputPollingInterval = null;
-        
-        // DOM elements
-        const statusLight = document.getElementById('status-light');
-        const statusText = document.getElementById('status-text');
-        const terminal = document.getElementById('terminal');
-        const commandInput = document.getElementById('command');
-        const sendButton = document.getElementById('send-command');
-        const clearButton = document.getElementById('clear-terminal');
-        const refreshStatusButton = document.getElementById('refresh-status');
-        const disconnectButton = document.getElementById('disconnect-client');
-        
-        // Update the connection status
-        async function updateStatus() {
-            try {
-                // Add a timestamp to prevent caching
-                const timestamp = new Date().getTime();
-                const url = `${API_URL}/status?_=${timestamp}`;
-                
-                debugConsole.log(`Fetching status from: ${url}`);
-                
-                const response = await fetch(url, {
-                    method: 'GET',
-                    headers: { 'Accept': 'application/json' },
-                    cache: 'no-store'
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error ${response.status}: ${response.statusText}`);
-                }
-                
-                const data = await response.json();
-                debugConsole.log(`Status response: ${JSON.stringify(data)}`);
-                
-                // Update API status display
-                apiStatusElement.innerHTML = `Connected to API at <strong>${API_URL}</strong> <span style="color: green;">✓</span>`;
-                
-                isConnected = data.connected;
-                
-                if (isConnected) {
-                    statusLight.classList.remove('disconnected');
-                    statusLight.classList.add('connected');
-                    statusText.textContent = `Connected to ${data.client}`;
-                    disconnectButton.disabled = false;
-                    
-                    debugConsole.log(`Connected to client: ${data.client}`);
-                    
-                    // Start polling for output if not already doing so
-                    if (!outputPollingInterval) {
-                        outputPollingInterval = setInterval(fetchOutput, 1000);
-                        debugConsole.log('Started output polling');
-                    }
-                } else {
-                    statusLight.classList.remove('connected');
-                    statusLight.classList.add('disconnected');
-                    statusText.textContent = 'Disconnected';
-                    disconnectButton.disabled = true;
-                    
-                    debugConsole.log('No client connected to server');
-                    
-                    // Stop polling if disconnected
-                    if (outputPollingInterval) {
-                        clearInterval(outputPollingInterval);
-                        outputPollingInterval = null;
-                        debugConsole.log('Stopped output polling');
-                    }
-                }
-            } catch (error) {
-                debugConsole.error(`Status error: ${error.message}`);
-                
-                statusLight.classList.remove('connected');
-                statusLight.classList.add('disconnected');
-                statusText.textContent = 'API Error';
-                disconnectButton.disabled = true;
-                
-                // Update API status display with error
-                apiStatusElement.innerHTML = `Error connecting to API at <strong>${API_URL}</strong>: ${error.message} <span style="color: red;">✗</span>`;
-                
-                // Stop polling if there's an API error
-                if (outputPollingInterval) {
-                    clearInterval(outputPollingInterval);
-                    outputPollingInterval = null;
-                    debugConsole.log('Stopped output polling due to error');
-                }
-            }
-        }
+@app.route('/drain', methods=['POST'])
+def start_drain():
+    """Stop accepting and dispatching jobs, optionally shutting down once drained.
+    
+    With ``shutdown`` the server waits up to ``timeout`` seconds for running
+    jobs in the background, then saves its state and exits. Otherwise
+    DELETE /drain resumes normal operation.
+    """
+    global draining, drain_deadline
+    
+    data = request.get_json(silent=True) or {}
+    timeout = data.get('timeout', DRAIN_TIMEOUT)
+    if not isinstance(timeout, (int, float)) or timeout < 0:
+        return jsonify({"error": "'timeout' must be a non-negative number of seconds"}), 400
+    
+    if data.get('shutdown'):
+        # Set before answering, so that the drain can no longer be undone
+        drain_deadline = min(drain_deadline or float("inf"), time.time() + timeout)
         
-        // Send a command to the server
-        async function sendCommand() {
-            const command = commandInput.value.trim();
-            if (!command) return;
+        def drain_and_stop():
+            drain(timeout)
+            os.kill(os.getpid(), signal.SIGTERM)
+        threading.Thread(target=drain_and_stop, daemon=True).start()
+    else:
+        draining = True
+    
+    return jsonify({
+        "status": "success",
+        "message": "Draining" + (", shutting down when done" if data.get('shutdown') else ""),
+        "running_jobs": in_flight_count()
+    })
+
+@app.route('/drain', methods=['DELETE'])
+def stop_drain():
+    """Accept and dispatch jobs again after a drain without shutdown."""
+    global draining
+    
+    if drain_deadline is not None:
+        return jsonify({"error": "Server is shutting down"}), 409
+    draining = False
+    return jsonify({
+        "status": "success",
+        "message": "Accepting jobs again"
+    })
+
+def load_static_assets():
+    """Read the web interface assets and precompress them once."""
+    for root, dirs, files in os.walk(STATIC_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            asset_name = os.path.relpath(path, STATIC_DIR).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
             
-            try {
-                // Add a timestamp to prevent caching
-                const timestamp = new Date().getTime();
-                const url = `${API_URL}/command?_=${timestamp}`;
-                
-                debugConsole.log(`Sending command to: ${url}`);
-                debugConsole.log(`Command: ${command}`);
-                
-                const response = await fetch(url, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'Accept': 'application/json'
-                    },
-                    body: JSON.stringify({ command }),
-                    cache: 'no-store'
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error ${response.status}: ${response.statusText}`);
-                }
-                
-                const data = await response.json();
-                debugConsole.log(`Command response: ${JSON.stringify(data)}`);
-                
-                // Add the command to the terminal with a prompt
-                appendToTerminal(`$ ${command}\n`);
-                commandInput.value = '';
-            } catch (error) {
-                debugConsole.error(`Error sending command: ${error.message}`);
-                appendToTerminal(`Error: Could not send command to the server - ${error.message}\n`);
-            }
-        }
-        
-        // Fetch output from the server
-        async function fetchOutput() {
-            try {
-                // Add a timestamp to prevent caching
-                const timestamp = new Date().getTime();
-                const url = `${API_URL}/output?_=${timestamp}`;
-                
-                debugConsole.log(`Fetching output from: ${url}`);
-                
-                const response = await fetch(url, {
-                    method: 'GET',
-                    headers: { 'Accept': 'application/json' },
-                    cache: 'no-store'
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error ${response.status}: ${response.statusText}`);
-                }
-                
-                const data = await response.json();
-                
-                if (data.outputs && data.outputs.length > 0) {
-                    debugConsole.log(`Received ${data.outputs.length} output items`);
-                    data.outputs.forEach(output => {
-                        appendToTerminal(output);
-                    });
-                }
-            } catch (error) {
-                debugConsole.error(`Error fetching output: ${error.message}`);
-            }
-        }
-        
-        // Clear the terminal
-        async function clearTerminal() {
-            terminal.textContent = '';
+            # Keep compressed variants only when they are actually smaller
+            variants = {"identity": data}
+            compressed = gzip.compress(data, 9)
+            if len(compressed) < len(data):
+                variants["gzip"] = compressed
+            if brotli:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    variants["br"] = compressed
             
-            // Also clear the server-side queues
-            try {
-                // Add a timestamp to prevent caching
-                const timestamp = new Date().getTime();
-                const response = await fetch(`${API_URL}/clear?_=${timestamp}`, { 
-                    method: 'POST',
-                    headers: { 'Accept': 'application/json' },
-                    cache: 'no-store'
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error ${response.status}: ${response.statusText}`);
-                }
-            } catch (error) {
-                console.error('Error clearing queues:', error);
-                appendToTerminal(`Error clearing queues: ${error.message}\n`);
-            }
-        }
-        
-        // Disconnect the client
-        async function disconnectClient() {
-            try {
-                // Add a timestamp to prevent caching
-                const timestamp = new Date().getTime();
-                const response = await fetch(`${API_URL}/disconnect?_=${timestamp}`, { 
-                    method: 'POST',
-                    headers: { 'Accept': 'application/json' },
-                    cache: 'no-store'
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error ${response.status}: ${response.statusText}`);
-                }
-                
-                const data = await response.json();
-                appendToTerminal(`System: ${data.message}\n`);
-                
-                // Update status immediately
-                updateStatus();
-            } catch (error) {
-                console.error('Error disconnecting client:', error);
-                appendToTerminal(`Error: Could not disconnect client - ${error.message}\n`);
-            }
-        }
-        
-        // Append text to the terminal and scroll to bottom
-        function appendToTerminal(text) {
-            terminal.textContent += text;
-            terminal.scrollTop = terminal.scrollHeight;
-        }
-        
-        // Event listeners
-        sendButton.addEventListener('click', sendCommand);
-        clearButton.addEventListener('click', clearTerminal);
-        refreshStatusButton.addEventListener('click', updateStatus);
-        disconnectButton.addEventListener('click', disconnectClient);
-        
-        commandInput.addEventListener('keypress', (e) => {
-            if (e.key === 'Enter') {
-                sendCommand();
-            }
-        });
-        
-        // Set up API URL form
-        const apiUrlInput = document.getElementById('api-url');
-        const apiForm = document.getElementById('api-form');
-        const currentApiUrlDisplay = document.getElementById('current-api-url');
-        const apiStatusElement = document.getElementById('api-status');
-        
-        // Initialize the API URL input with the current value
-        apiUrlInput.value = API_URL;
-        currentApiUrlDisplay.textContent = API_URL;
-        
-        // Function to test API connection
-        async function testApiConnection(url) {
-            try {
-                const response = await fetch(`${url}/status`, { 
-                    method: 'GET',
-                    headers: { 'Accept': 'application/json' },
-                    // Add a cache-busting parameter to prevent caching
-                    cache: 'no-store'
-                });
-                
-                if (response.ok) {
-                    apiStatusElement.innerHTML = `Connected to API at <strong>${url}</strong> <span style="color: green;">✓</span>`;
-                    return true;
-                } else {
-                    apiStatusElement.innerHTML = `Error connecting to API at <strong>${url}</strong>: ${response.status} ${response.statusText} <span style="color: red;">✗</span>`;
-                    return false;
-                }
-            } catch (error) {
-                apiStatusElement.innerHTML = `Failed to connect to API at <strong>${url}</strong>: ${error.message} <span style="color: red;">✗</span>`;
-                return false;
-            }
-        }
-        
-        // Test the current API connection
-        testApiConnection(API_URL);
-        
-        // Handle form submission
-        apiForm.addEventListener('submit', function(e) {
-            e.preventDefault();
-            const newApiUrl = apiUrlInput.value.trim();
-            if (newApiUrl) {
-                // Save to localStorage
-                localStorage.setItem('apiUrl', newApiUrl);
-                
-                // Update the current API URL
-                currentApiUrlDisplay.textContent = newApiUrl;
-                
-                // Test the connection
-                testApiConnection(newApiUrl).then(success => {
-                    if (success) {
-                        // Reload the page to use the new API URL
-                        window.location.reload();
-                    }
-                });
-            }
-        });
-        
-        // Add debug console
-        const debugConsole = {
-            log: function(message) {
-                console.log(message);
-                if (localStorage.getItem('debugMode') === 'true') {
-                    const debugArea = document.getElementById('debug-console');
-                    if (debugArea) {
-                        const timestamp = new Date().toLocaleTimeString();
-                        debugArea.textContent += `[${timestamp}] ${message}\n`;
-                        debugArea.scrollTop = debugArea.scrollHeight;
-                    }
-                }
-            },
-            error: function(message) {
-                console.error(message);
-                if (localStorage.getItem('debugMode') === 'true') {
-                    const debugArea = document.getElementById('debug-console');
-                    if (debugArea) {
-                        const timestamp = new Date().toLocaleTimeString();
-                        debugArea.textContent += `[${timestamp}] ERROR: ${message}\n`;
-                        debugArea.scrollTop = debugArea.scrollHeight;
-                    }
-                }
-            },
-            clear: function() {
-                const debugArea = document.getElementById('debug-console');
-                if (debugArea) {
-                    debugArea.textContent = '';
-                }
-            }
-        };
-        
-        // Toggle debug mode
-        document.getElementById('toggle-debug').addEventListener('click', function() {
-            const debugSection = document.getElementById('debug-section');
-            if (debugSection.style.display === 'none') {
-                debugSection.style.display = 'block';
-                localStorage.setItem('debugMode', 'true');
-                this.textContent = 'Hide Debug Console';
-            } else {
-                debugSection.style.display = 'none';
-                localStorage.setItem('debugMode', 'false');
-                this.textContent = 'Show Debug Console';
+            static_assets[asset_name] = {
+                "etag": hashlib.sha256(data).hexdigest()[:16],
+                "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                "cache_control": STATIC_CACHE_CONTROL.get(os.path.splitext(name)[1],
+                                                          DEFAULT_STATIC_CACHE_CONTROL),
+                "variants": variants
             }
-        });
-        
-        // Initialize debug console visibility
-        const debugSection = document.getElementById('debug-section');
-        if (localStorage.getItem('debugMode') === 'true') {
-            debugSection.style.display = 'block';
-            document.getElementById('toggle-debug').textContent = 'Hide Debug Console';
-        } else {
-            debugSection.style.display = 'none';
-            document.getElementById('toggle-debug').textContent = 'Show Debug Console';
-        }
-        
-        // Log initial API URL
-        debugConsole.log(`Using API URL: ${API_URL}`);
-        
-        // Initial status check
-        updateStatus();
-        
-        // Check status periodically
-        setInterval(updateStatus, 5000);
-    </script>
-</body>
-</html>"""
-    return html_content
+    
+    print(f"[Server] Loaded {len(static_assets)} static assets "
+          f"({'gzip, br' if brotli else 'gzip'} precompressed)")
+
+def accepted_encodings():
+    """Return the content codings the client accepts, ignoring those with q=0."""
+    encodings = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+def serve_static_asset(asset_name):
+    """Serve a preloaded static asset, honouring conditional GETs."""
+    asset = static_assets.get(asset_name)
+    if not asset:
+        return jsonify({"error": "Not found"}), 404
+    
+    encoding = "identity"
+    accepted = accepted_encodings()
+    for candidate in ("br", "gzip"):
+        if candidate in asset["variants"] and candidate in accepted:
+            encoding = candidate
+            break
+    
+    # Each encoding is a different representation and needs its own ETag
+    etag = asset["etag"] if encoding == "identity" else f"{asset['etag']}-{encoding}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset["variants"][encoding], mimetype=asset["mimetype"])
+        if encoding != "identity":
+            response.headers['Content-Encoding'] = encoding
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = asset["cache_control"]
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/')
+def index():
+    """Serve the web interface."""
+    return serve_static_asset("index.html")
+
+@app.route('/static/<path:asset_name>')
+def static_file(asset_name):
+    """Serve a static asset of the web interface."""
+    return serve_static_asset(asset_name)
+
+load_static_assets()
+
+def signal_handler(sig, frame):
+    """Handle SIGTERM like Ctrl+C so that the server shuts down gracefully."""
+    raise KeyboardInterrupt
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    # Pick up where the previous run left off
+    load_snapshot()
+    
     # Start the socket server in a separate thread
     server_thread = threading.Thread(target=socket_server, daemon=True)
     server_thread.start()
     
+    # Start the timer thread for watches and recurring schedules
+    timer_thread = threading.Thread(target=timer_loop, daemon=True)
+    timer_thread.start()
+    
     try:
         # Start the Flask API
         print("[Server] Starting Flask API on port 8080...")
         app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
     finally:
-        # Signal the server to stop
+        # Let running jobs finish, then signal the server to stop and save
+        # what is left for the next start
+        print("[Server] Draining...")
+        remaining = drain()
+        if remaining:
+            print(f"[Server] {remaining} jobs still running; they resume when their agents reconnect")
         server_running = False
+        stop_timers()
+        save_snapshot()
         print("[Server] Shutting down...")
\ No newline at end of file